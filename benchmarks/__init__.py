@@ -0,0 +1,3 @@
+"""
+Benchmarks run from a checkout, they are not part of the installed package
+"""
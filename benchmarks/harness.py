@@ -0,0 +1,630 @@
+"""
+End to end benchmark that runs without the game, mpv or youtube.
+
+    python -m benchmarks.harness [options] [-- mouselounge options]
+
+Stand-ins for tcpdump, youtube-dl and mpv are put in front of PATH, they
+are this module again running as a different persona:
+
+- tcpdump writes a pcap stream of links at the requested rate, or
+  replays a recorded capture with fresh timestamps, tcpflow does the
+  same in its console format when --fetcher tcpflow is given
+- youtube-dl prints signed looking stream urls after a delay
+- mpv serves enough of the JSON IPC on its socket to play playlists
+
+Watch pages come from a local HTTP server, either recorded pages from
+--pages or generated ones, with injected latency and failures. Every
+persona logs what it did with timestamps into the work directory, the
+report matches the captured links to the loadfiles mpv got. The run
+fails if the shutdown after the capture ends takes over --shutdown-budget.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+
+from collections import defaultdict
+from contextlib import suppress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+from mouselounge.framing import PcapFramer
+from mouselounge.looplag import LAG
+from mouselounge.stats import STATS
+from mouselounge.tracing import Histogram
+from mouselounge.utils import VIDEO_ID, Video
+from tests.fakes import ID_CHARS, PcapWriter, TcpflowWriter, tribehouse_payload
+
+__all__ = ["FakeMpv", "WatchPages", "prepare", "main"]
+
+LOGGER = logging.getLogger(__name__)
+
+CONFIG_ENV = "MOUSELOUNGE_HARNESS"
+PERSONAS = ("tcpdump", "tcpflow", "youtube-dl", "mpv")
+FETCHERS = ("tcpdump", "tcpflow")
+
+PAGE = """<!DOCTYPE html><html><head>
+<meta itemprop="name" content="{title}">
+<meta itemprop="duration" content="PT{minutes}M{seconds}S">
+<meta itemprop="description" content="Harness video {id}, nothing to see here.">
+</head><body></body></html>
+"""
+
+
+def config():
+    return json.loads(os.environ[CONFIG_ENV])
+
+
+def log_path(cfg, name):
+    return os.path.join(cfg["workdir"], f"{name}.jsonl")
+
+
+def read_log(cfg, name):
+    with suppress(FileNotFoundError), open(log_path(cfg, name)) as log:
+        return [json.loads(line) for line in log if line.strip()]
+    return []
+
+
+def random_id():
+    return "".join(random.choices(ID_CHARS, k=11))
+
+
+def video_id(url):
+    """Id of the video a loadfile url belongs to"""
+    query = parse_qs(urlsplit(url).query)
+    for name in "id", "v":
+        if name in query:
+            return query[name][0]
+    match = VIDEO_ID.search(url)
+    return match.group(1) if match else None
+
+
+def fake_tcpdump(_argv):
+    return fetch(PcapWriter(sys.stdout.buffer))
+
+
+def fake_tcpflow(_argv):
+    return fetch(TcpflowWriter(sys.stdout.buffer))
+
+
+def fetch(writer):
+    cfg = config()
+    sent = 0
+    with open(log_path(cfg, "feed"), "a", buffering=1) as log:
+
+        def send(payload, ts, flow=None):
+            writer.write(payload, ts, flow)
+            for match in VIDEO_ID.finditer(payload.decode("latin1")):
+                log.write(json.dumps({"ts": ts, "id": match.group(1)}) + "\n")
+
+        if cfg["pcap"]:
+            with open(cfg["pcap"], "rb") as recorded:
+                records = PcapFramer().feed(recorded.read())
+            start = monotonic()
+            first = records[0].ts if records else 0.0
+            for record in records[: cfg["count"] or None]:
+                # keep the recorded gaps, but the timestamps are ours
+                delay = record.ts - first - (monotonic() - start)
+                if delay > 0:
+                    sleep(delay)
+                send(record.payload, time(), record.flow)
+                sent += 1
+        else:
+            interval = 1.0 / cfg["rate"]
+            start = monotonic()
+            for num in range(cfg["count"]):
+                delay = start + num * interval - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                send(tribehouse_payload(random_id()), time())
+                sent += 1
+    # keep the capture going until mpv got everything or nothing moves anymore
+    deadline = monotonic() + cfg["drain"]
+    seen, changed = -1, monotonic()
+    while monotonic() < deadline:
+        loaded = len(read_log(cfg, "mpv"))
+        if loaded >= sent:
+            break
+        if loaded != seen:
+            seen, changed = loaded, monotonic()
+        elif monotonic() - changed > cfg["settle"]:
+            break
+        sleep(0.05)
+    return 0
+
+
+def fake_youtube_dl(argv):
+    cfg = config()
+    sleep(random.uniform(0, 2) * cfg["resolve_latency"] / 1000)
+    url = argv[-1]
+    if random.random() < cfg["resolve_failures"]:
+        print(f"ERROR: {url}: injected failure", file=sys.stderr)
+        return 1
+    vid = video_id(url)
+    expire = int(time()) + 6 * 3600
+    base = f"http://127.0.0.1:{cfg['http_port']}/videoplayback?id={vid}&expire={expire}"
+    if "-o" in argv:
+        with open(argv[argv.index("-o") + 1], "wb") as out:
+            out.write(os.urandom(1024))
+        return 0
+    fmt = argv[argv.index("-f") + 1] if "-f" in argv else ""
+    print(f"{base}&itag=video")
+    if "+" in fmt:
+        print(f"{base}&itag=audio")
+    return 0
+
+
+class FakeMpv:
+    """
+    Plays a playlist of urls by sending the events mpv would, with
+    `load_delay` between loadfile and the first frame and every entry
+    lasting `play_time` seconds. Quits with its last client, like mpv
+    quits when mouselounge tells it to.
+    """
+
+    def __init__(self, path, load_delay=0.0, play_time=0.0, log=None):
+        self.path = path
+        self.load_delay = load_delay
+        self.play_time = play_time
+        self.log = log
+        self.observed = {}
+        self.props = {"idle-active": True, "playlist-pos": -1, "time-remaining": None}
+        self.playlist = []
+        self.writers = set()
+        self.served = False
+        self.timers = []
+        self.done = None
+
+    async def serve(self):
+        self.done = asyncio.get_running_loop().create_future()
+        server = await asyncio.start_unix_server(self._client, self.path)
+        async with server:
+            await self.done
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    async def _client(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while line := await reader.readline():
+                with suppress(ValueError):
+                    self.command(json.loads(line), writer)
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            # connections that never said anything only checked the socket
+            if not self.writers and self.served:
+                self.quit()
+
+    def send(self, msg, writer=None):
+        line = f"{json.dumps(msg)}\n".encode("utf8")
+        for out in [writer] if writer else list(self.writers):
+            with suppress(Exception):
+                out.write(line)
+
+    def set(self, name, value):
+        self.props[name] = value
+        if name in self.observed:
+            self.send(
+                {
+                    "event": "property-change",
+                    "id": self.observed[name],
+                    "name": name,
+                    "data": value,
+                }
+            )
+
+    def command(self, msg, writer):
+        self.served = True
+        cmd = msg.get("command") or []
+        if isinstance(cmd, dict):
+            name, args = cmd.get("name"), [cmd.get("url"), cmd.get("flags", "replace")]
+        else:
+            name, args = cmd[0], cmd[1:]
+        data = None
+        if name == "loadfile":
+            self.loadfile(args[0], args[1] if len(args) > 1 else "replace")
+        elif name == "observe_property":
+            self.observed[args[1]] = args[0]
+        elif name == "get_property":
+            data = self.props.get(args[0])
+        elif name == "set_property":
+            self.props[args[0]] = args[1]
+        elif name == "playlist-clear":
+            pos = self.props["playlist-pos"]
+            if pos >= 0:
+                self.playlist = self.playlist[pos : pos + 1]
+                self.set("playlist-pos", 0)
+            else:
+                self.playlist = []
+        elif name in ("stop", "quit"):
+            self.stop()
+        reply = {"error": "success", "data": data}
+        if "request_id" in msg:
+            reply["request_id"] = msg["request_id"]
+        self.send(reply, writer)
+        if name == "observe_property":
+            self.set(args[1], self.props.get(args[1]))
+        elif name == "quit":
+            self.quit()
+
+    def loadfile(self, url, flags):
+        if self.log is not None:
+            entry = {"ts": time(), "url": url, "flags": flags}
+            self.log.write(json.dumps(entry) + "\n")
+        if flags == "replace":
+            if self.props["playlist-pos"] >= 0:
+                self.send({"event": "end-file", "reason": "stop"})
+            self.playlist = [url]
+            self.start(0)
+        else:
+            self.playlist.append(url)
+            if flags == "append-play" and self.props["idle-active"]:
+                self.start(len(self.playlist) - 1)
+
+    def _later(self, delay, callback, *args):
+        loop = asyncio.get_running_loop()
+        self.timers.append(loop.call_later(delay, callback, *args))
+
+    def start(self, pos):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        self.send({"event": "start-file", "playlist_entry_id": pos + 1})
+        self.set("playlist-pos", pos)
+        self.set("idle-active", False)
+        self._later(self.load_delay, self.loaded)
+
+    def loaded(self):
+        self.send({"event": "file-loaded"})
+        self.send({"event": "playback-restart"})
+        self.set("time-remaining", self.play_time)
+        self._later(self.play_time, self.ended)
+
+    def ended(self):
+        self.send({"event": "end-file", "reason": "eof"})
+        # playlist-clear moves the playing entry to the front
+        pos = self.props["playlist-pos"]
+        if pos + 1 < len(self.playlist):
+            self.start(pos + 1)
+        else:
+            self.stop()
+
+    def stop(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        self.set("time-remaining", None)
+        self.set("playlist-pos", -1)
+        self.set("idle-active", True)
+
+    def quit(self):
+        if self.done is not None and not self.done.done():
+            self.done.set_result(None)
+
+
+def fake_mpv(argv):
+    cfg = config()
+    path = next(
+        a.split("=", 1)[1] for a in argv if a.startswith("--input-ipc-server=")
+    )
+    with open(log_path(cfg, "mpv"), "a", buffering=1) as log:
+        mpv = FakeMpv(path, cfg["load_delay"] / 1000, cfg["play_time"], log)
+        asyncio.run(mpv.serve())
+    return 0
+
+
+class WatchPages:
+    """
+    Serves watch pages from its own threads, the manager fetches them
+    with blocking requests on the loop. `failures` of the requests either
+    get a 503 or a connection that is closed without any response.
+    """
+
+    def __init__(self, pages=None, latency=0.0, jitter=0.0, failures=0.0):
+        self.pages = []
+        if pages:
+            for name in sorted(os.listdir(pages)):
+                with open(os.path.join(pages, name), encoding="utf8") as page:
+                    self.pages.append(page.read())
+        self.latency = latency
+        self.jitter = jitter
+        self.failures = failures
+        self.served = 0
+        self.failed = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True, name="WatchPages"
+        )
+
+    def page(self, vid):
+        if self.pages:
+            return self.pages[sum(map(ord, vid)) % len(self.pages)]
+        seconds = sum(map(ord, vid)) % 600 + 30
+        return PAGE.format(
+            id=vid,
+            title=f"Harness video {vid}",
+            minutes=seconds // 60,
+            seconds=seconds % 60,
+        )
+
+    def _handler(self):
+        pages = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sleep(max(pages.latency + random.uniform(-1, 1) * pages.jitter, 0))
+                if random.random() < pages.failures:
+                    pages.failed += 1
+                    if random.random() < 0.5:
+                        self.send_error(503)
+                    else:
+                        self.close_connection = True
+                        with suppress(OSError):
+                            self.connection.shutdown(2)
+                    return
+                body = pages.page(video_id(self.path) or "").encode("utf8")
+                pages.served += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def install_personas(workdir, fetcher="tcpdump"):
+    """Puts the stand-ins in front of PATH, only one of the fetchers"""
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for persona in PERSONAS:
+        if persona in FETCHERS and persona != fetcher:
+            continue
+        path = os.path.join(bindir, persona)
+        with open(path, "w") as script:
+            script.write(
+                "#!/bin/sh\n"
+                f'PYTHONPATH="{root}${{PYTHONPATH:+:$PYTHONPATH}}" '
+                f'exec "{sys.executable}" -m benchmarks.harness {persona} "$@"\n'
+            )
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+
+
+def prepare(workdir, pages, **options):
+    """
+    Points everything at the stand-ins, has to run before the process
+    pool gets forked, which happens when the managers are imported.
+    """
+    cfg = dict(
+        workdir=workdir,
+        http_port=pages.port,
+        fetcher="tcpdump",
+        count=0,
+        rate=1.0,
+        pcap=None,
+        resolve_latency=0.0,
+        resolve_failures=0.0,
+        load_delay=20.0,
+        play_time=0.0,
+        settle=3.0,
+        drain=60.0,
+    )
+    cfg.update(options)
+    os.environ[CONFIG_ENV] = json.dumps(cfg)
+    install_personas(workdir, cfg["fetcher"])
+    Video.watch_url = f"http://127.0.0.1:{pages.port}/watch?v={{}}"
+    return cfg
+
+
+def report(cfg, pages, elapsed):
+    feed = read_log(cfg, "feed")
+    loads = read_log(cfg, "mpv")
+    captured = {}
+    for item in feed:
+        captured.setdefault(item["id"], item["ts"])
+    latency = Histogram()
+    flags = defaultdict(int)
+    first_load = {}
+    for item in loads:
+        vid = video_id(item["url"])
+        flags[item["flags"]] += 1
+        if vid in captured and vid not in first_load:
+            first_load[vid] = item["ts"]
+            latency.record(max(item["ts"] - captured[vid], 0.0))
+    lines = [
+        f"Links captured: {len(captured)}, loadfiles: {len(loads)} "
+        f"({', '.join(f'{k} {v}' for k, v in sorted(flags.items())) or 'none'}), "
+        f"matched: {len(first_load)}",
+        f"Watch pages served: {pages.served}, failed on purpose: {pages.failed}",
+        f"Link to loadfile: {latency}",
+    ]
+    if first_load:
+        span = max(first_load.values()) - min(captured[v] for v in first_load)
+        rate = len(first_load) / span if span > 0 else float("inf")
+        lines.append(f"Sustained: {rate:.1f} events/s over {span:.2f}s")
+    lines.append(LAG.dump())
+    lines.append(f"Wall time: {elapsed:.2f}s")
+    reloads = STATS.value("mouselounge_manager_reloads_total")
+    if reloads:
+        lines.append(
+            f"Reloads: {reloads}, the last one took "
+            f"{STATS.value('mouselounge_manager_reload_seconds') * 1000:.1f} ms"
+        )
+    lines.append(
+        f"Shutdown: {STATS.value('mouselounge_shutdown_seconds') or 0.0:.2f}s"
+    )
+    return "\n".join(lines)
+
+
+def split_argv(argv):
+    """Own arguments and the ones after -- that are for mouselounge"""
+    if "--" in argv:
+        split = argv.index("--")
+        return argv[:split], argv[split + 1 :]
+    return argv, []
+
+
+def parse_args(argv):
+    args = argparse.Namespace()
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.harness",
+        description="Offline end to end benchmark, anything after -- "
+        "goes to mouselounge itself",
+    )
+    parser.add_argument("-n", "--count", type=int, default=200, help="Links to send")
+    parser.add_argument(
+        "-r", "--rate", type=float, default=50.0, help="Links per second"
+    )
+    parser.add_argument(
+        "--pcap", metavar="FILE", help="Replay a recorded tcpdump capture instead"
+    )
+    parser.add_argument(
+        "--fetcher", choices=FETCHERS, default="tcpdump",
+        help="Which fetcher mouselounge gets to read (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pages", metavar="DIR", help="Directory of recorded watch pages"
+    )
+    parser.add_argument("--http-latency", type=float, default=0.0, metavar="MS")
+    parser.add_argument("--http-jitter", type=float, default=0.0, metavar="MS")
+    parser.add_argument(
+        "--http-failures", type=float, default=0.0, metavar="RATE",
+        help="Share of the watch page requests that fail",
+    )
+    parser.add_argument(
+        "--resolve-latency", type=float, default=0.0, metavar="MS",
+        help="Average time youtube-dl takes to print the stream urls",
+    )
+    parser.add_argument("--resolve-failures", type=float, default=0.0, metavar="RATE")
+    parser.add_argument(
+        "--load-delay", type=float, default=20.0, metavar="MS",
+        help="Time mpv takes from loadfile to the first frame",
+    )
+    parser.add_argument(
+        "--play-time", type=float, default=0.0, metavar="SECS",
+        help="How long every video plays, queued videos wait for this",
+    )
+    parser.add_argument(
+        "--settle", type=float, default=3.0, metavar="SECS",
+        help="Stop once no loadfile came for this long after the last link",
+    )
+    parser.add_argument("--drain", type=float, default=60.0, metavar="SECS")
+    parser.add_argument(
+        "--shutdown-budget", type=float, default=3.0, metavar="SECS",
+        help="Fail if mouselounge takes longer than this to shut down",
+    )
+    parser.add_argument(
+        "--reload-every", type=float, default=0.0, metavar="SECS",
+        help="Reload the managers this often during the run, "
+        "with SIGHUP, so mouselounge has to run with --daemon",
+    )
+    parser.add_argument("-d", "--debug", action="store_true")
+    own, args.mouselounge = split_argv(argv)
+    args = parser.parse_args(own, args)
+    daemon = any(a.startswith(("-D", "--daemon")) for a in args.mouselounge)
+    if args.reload_every > 0 and not daemon:
+        parser.error("--reload-every needs mouselounge to run with -D/--daemon")
+    return args
+
+
+def reload_every(interval, done):
+    """Sends the SIGHUP mouselounge reloads its managers on, till `done`"""
+    while not done.wait(interval):
+        os.kill(os.getpid(), signal.SIGHUP)
+
+
+def bench(argv):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s %(threadName)s %(levelname)s %(module)s: %(message)s",
+    )
+    pages = WatchPages(
+        args.pages,
+        args.http_latency / 1000,
+        args.http_jitter / 1000,
+        args.http_failures,
+    )
+    pages.start()
+    with tempfile.TemporaryDirectory(prefix="mouselounge-harness-") as workdir:
+        cfg = prepare(
+            workdir,
+            pages,
+            fetcher=args.fetcher,
+            count=args.count,
+            rate=args.rate,
+            pcap=args.pcap,
+            resolve_latency=args.resolve_latency,
+            resolve_failures=args.resolve_failures,
+            load_delay=args.load_delay,
+            play_time=args.play_time,
+            settle=args.settle,
+            drain=args.drain,
+        )
+        # pylint: disable=import-outside-toplevel
+        from mouselounge.__main__ import listen, parse_args as mouselounge_args
+        from mouselounge.capture import PacketFetcherError
+
+        reloading = threading.Event()
+        if args.reload_every > 0:
+            threading.Thread(
+                daemon=True,
+                target=reload_every,
+                args=(args.reload_every, reloading),
+                name="Reloader",
+            ).start()
+        start = monotonic()
+        try:
+            listen(mouselounge_args(["--fetcher", args.fetcher] + args.mouselounge))
+        except PacketFetcherError:
+            LOGGER.error("Capture failed")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reloading.set()
+        print(report(cfg, pages, monotonic() - start), file=sys.stderr)
+    pages.close()
+    shutdown = STATS.value("mouselounge_shutdown_seconds") or 0.0
+    if shutdown > args.shutdown_budget:
+        LOGGER.error(
+            "Shutdown took %.2fs, over the budget of %.2fs",
+            shutdown,
+            args.shutdown_budget,
+        )
+        return 1
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in PERSONAS:
+        persona = argv[0].replace("-", "_")
+        return globals()[f"fake_{persona}"](argv[1:])
+    return bench(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
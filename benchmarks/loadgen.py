@@ -0,0 +1,256 @@
+"""
+Load generator that feeds simulated rooms into the listeners, the same
+way decoded packets come out of the ProtocolHandler.
+
+    python -m benchmarks.loadgen [options] [-- mouselounge options]
+
+Every room posts links at its own poisson rate, some of them reposts of
+recent links and optionally with bursts on top. The rate goes up by
+--factor every step until the dispatch latency or the achieved rate
+shows the loop can't keep up anymore. Watch pages, youtube-dl and mpv
+are the stand-ins from the harness.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+from collections import deque
+from contextlib import suppress
+from time import time
+
+from benchmarks.harness import WatchPages, prepare, random_id, split_argv
+from mouselounge.looplag import LAG
+from mouselounge.tracing import Histogram
+
+__all__ = ["Step", "main"]
+
+LOGGER = logging.getLogger(__name__)
+
+# the value play_vid_tribehouse is decoded from
+KEY = b"\x1a\x0c\x01"
+
+
+def rss():
+    with suppress(OSError), open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return 0
+
+
+class Step:
+    """Results of running the rooms at one rate"""
+
+    def __init__(self, rate, offered):
+        self.rate = rate
+        self.offered = offered
+        self.sent = 0
+        self.elapsed = 0.0
+        self.latency = Histogram()
+        self.sizes = {}
+
+    @property
+    def achieved(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def saturated(self, max_p99):
+        return (
+            self.latency.percentile(99) > max_p99 or self.achieved < self.offered * 0.9
+        )
+
+
+def sizes(api, handler):
+    """Sizes of everything that grows with the number of links"""
+    web = [
+        m
+        for m in handler.community_managers + handler.game_managers
+        if hasattr(m, "streams")
+    ]
+    result = {
+        "cooldown": sum(len(m.cooldown) for m in web),
+        "metadata": sum(len(m.metadata) for m in web),
+        "streams": sum(len(m.streams.cache) for m in web),
+        "queue": sum(len(m.playqueue) for m in web),
+        "timers": len(api.scheduler),
+        "rss": rss(),
+    }
+    if tracemalloc.is_tracing():
+        result["traced"] = tracemalloc.get_traced_memory()[0]
+    return result
+
+
+async def room(api, args, rate, until, recent, step):
+    loop = api.loop
+    due = loop.time() + random.expovariate(rate)
+    next_burst = (
+        loop.time() + random.uniform(0, args.burst_every) if args.burst else until
+    )
+    while not api.interrupted:
+        at = min(due, next_burst)
+        if at >= until:
+            break
+        await asyncio.sleep(max(at - loop.time(), 0))
+        if next_burst <= due:
+            count = args.burst
+            next_burst += args.burst_every
+        else:
+            count = 1
+            due += random.expovariate(rate)
+        for _ in range(count):
+            if recent and random.random() < args.duplicates:
+                vid = random.choice(recent)
+            else:
+                vid = random_id()
+                recent.append(vid)
+            api.dispatch(KEY, (f"https://www.youtube.com/watch?v={vid}",), time())
+            # from when the link should have arrived, so loop lag counts too
+            step.latency.record(loop.time() - at)
+            step.sent += 1
+
+
+async def ramp(api, handler, args):
+    # let the managers start before the first link
+    await asyncio.sleep(0.1)
+    recent = deque(maxlen=256)
+    steps = []
+    rate = args.rate
+    for _ in range(args.steps):
+        bursts = args.burst / args.burst_every if args.burst else 0.0
+        step = Step(rate, args.rooms * (rate + bursts))
+        start = api.loop.time()
+        until = start + args.step_time
+        await asyncio.gather(
+            *(room(api, args, rate, until, recent, step) for _ in range(args.rooms))
+        )
+        step.elapsed = api.loop.time() - start
+        step.sizes = sizes(api, handler)
+        steps.append(step)
+        LOGGER.info(
+            "%.1f links/s offered, %.1f achieved", step.offered, step.achieved
+        )
+        if api.interrupted or step.saturated(args.max_p99):
+            break
+        rate *= args.factor
+    return steps
+
+
+def report(steps, baseline, max_p99):
+    mib = 2 ** 20
+    lines = [
+        f"{'offered/s':>10} {'achieved/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'max ms':>8} {'cooldown':>8} {'metadata':>8} {'streams':>7} "
+        f"{'queue':>6} {'timers':>6} {'rss MiB':>8}"
+    ]
+    for step in steps:
+        size = step.sizes
+        lines.append(
+            f"{step.offered:>10.1f} {step.achieved:>10.1f} "
+            f"{step.latency.percentile(50):>8.1f} {step.latency.percentile(99):>8.1f} "
+            f"{step.latency.max:>8.1f} {size['cooldown']:>8} {size['metadata']:>8} "
+            f"{size['streams']:>7} {size['queue']:>6} {size['timers']:>6} "
+            f"{size['rss'] / mib:>8.1f}"
+        )
+    if steps:
+        last = steps[-1].sizes
+        growth = ", ".join(
+            f"{name} {last[name] - baseline[name]:+}"
+            for name in ("cooldown", "metadata", "streams", "timers")
+        )
+        lines.append(
+            f"Growth: {growth}, rss {(last['rss'] - baseline['rss']) / mib:+.1f} MiB"
+        )
+        if "traced" in last:
+            lines.append(
+                "Traced allocations: "
+                f"{(last['traced'] - baseline.get('traced', 0)) / mib:+.2f} MiB"
+            )
+    lines.append(LAG.dump())
+    healthy = [s for s in steps if not s.saturated(max_p99)]
+    if steps and steps[-1].saturated(max_p99):
+        capacity = (
+            f"{healthy[-1].offered:.1f}" if healthy else "less than the first step"
+        )
+        lines.append(
+            f"Saturated at {steps[-1].offered:.1f} links/s, "
+            f"capacity is {capacity} links/s"
+        )
+    elif steps:
+        lines.append(f"Didn't saturate up to {steps[-1].offered:.1f} links/s")
+    return "\n".join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.loadgen",
+        description="Finds how many links per second mouselounge keeps up with, "
+        "anything after -- goes to mouselounge itself",
+    )
+    parser.add_argument("--rooms", type=int, default=4, help="Rooms posting at once")
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="Links per second of every room"
+    )
+    parser.add_argument(
+        "--duplicates", type=float, default=0.1, metavar="RATIO",
+        help="Share of the links that repost one of the recent ones",
+    )
+    parser.add_argument(
+        "--burst", type=int, default=0, metavar="SIZE",
+        help="Every room also posts this many links at once now and then",
+    )
+    parser.add_argument("--burst-every", type=float, default=10.0, metavar="SECS")
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--step-time", type=float, default=5.0, metavar="SECS")
+    parser.add_argument(
+        "--factor", type=float, default=2.0, help="Rate multiplier between steps"
+    )
+    parser.add_argument(
+        "--max-p99", type=float, default=100.0, metavar="MS",
+        help="Dispatch latency over this counts as saturated",
+    )
+    parser.add_argument("--http-latency", type=float, default=0.0, metavar="MS")
+    parser.add_argument("--resolve-latency", type=float, default=0.0, metavar="MS")
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="Also trace python allocations"
+    )
+    parser.add_argument("-d", "--debug", action="store_true")
+    own, mouselounge = split_argv(argv)
+    args = parser.parse_args(own)
+    args.mouselounge = mouselounge
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(threadName)s %(levelname)s %(module)s: %(message)s",
+    )
+    if args.tracemalloc:
+        tracemalloc.start()
+    pages = WatchPages(latency=args.http_latency / 1000)
+    pages.start()
+    with tempfile.TemporaryDirectory(prefix="mouselounge-loadgen-") as workdir:
+        prepare(workdir, pages, resolve_latency=args.resolve_latency)
+        # pylint: disable=import-outside-toplevel
+        from mouselounge.__main__ import parse_args as mouselounge_args, setup
+        from mouselounge.mousapi import Mousapi
+
+        steps, baseline = [], {}
+        options = mouselounge_args(args.mouselounge)
+        try:
+            with Mousapi(options) as api:
+                handler = setup(api, options)
+                baseline = sizes(api, handler)
+                steps = api.loop.run_until_complete(ramp(api, handler, args))
+        except KeyboardInterrupt:
+            pass
+        print(report(steps, baseline, args.max_p99), file=sys.stderr)
+    pages.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
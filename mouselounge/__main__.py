@@ -2,17 +2,22 @@
 
 import logging
 import sys
-import os
 import datetime as dt
 import signal
 import argparse
 
 from shutil import which
-from time import sleep
 
 
 from .mousapi import Mousapi, PacketFetcherError
 from .handler import Managers, Handler
+from .quality import LEVEL_NAMES
+from .archive import parse_time, run_query
+from .control import ControlServer, TOPICS, run_client
+from .logs import start_logging
+from .tracing import TRACER
+from .looplag import LAG
+from .profiler import PROFILER, SNAPSHOTS
 from ._version import __fulltitle__
 
 LOGGER = logging.getLogger("mouselounge")
@@ -71,7 +76,30 @@ def debug_handler(_, frame):
     shell.interact(message)
 
 
-def parse_args():
+def trace_handler(_signum, _frame):
+    """Dumps latency histograms of the pipeline stages and the loop lag"""
+    print(TRACER.dump(), LAG.dump(), sep="\n", file=sys.stderr)
+
+
+def profile_handler(_signum, _frame):
+    """Starts the sampling profiler or stops it and writes the flamegraph file"""
+    PROFILER.toggle()
+
+
+def memory_handler(_signum, _frame):
+    """Logs allocation growth since the previous snapshot"""
+    LOGGER.info("%s", SNAPSHOTS.snapshot())
+
+
+def time_arg(value):
+    """parse_time for argparse, a bad time is a usage error then"""
+    try:
+        return parse_time(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(f"invalid time {value!r}: {ex}") from ex
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description=__fulltitle__)
     parser.add_argument(
         "-f",
@@ -81,6 +109,125 @@ def parse_args():
         help="Feed mode. Played videos will appear in the terminal but they "
         "won't be opened through mpv",
     )
+    parser.add_argument(
+        "-w",
+        "--warm-mpv",
+        action="store_true",
+        default=False,
+        help="Start mpv in the background right away and after it gets closed, "
+        "so videos don't have to wait for the player to start",
+    )
+    parser.add_argument(
+        "--no-queue",
+        action="store_true",
+        default=False,
+        help="Replace the video that is playing right now instead of "
+        "queueing new ones after it",
+    )
+    parser.add_argument(
+        "-a",
+        "--adaptive",
+        action="store_true",
+        default=False,
+        help="Lower the video quality when the cpu is busy, frames are dropped "
+        "or the video is buffering and raise it again when things calm down",
+    )
+    parser.add_argument(
+        "--max-quality",
+        choices=LEVEL_NAMES,
+        default="720p",
+        help="Best quality adaptive mode can pick (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min-quality",
+        choices=LEVEL_NAMES,
+        default="audio",
+        help="Worst quality adaptive mode can pick (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Keep frequently played videos in a local cache of at most this "
+        "many MiB. Disabled by default",
+    )
+    parser.add_argument(
+        "-e",
+        "--events",
+        metavar="TARGET",
+        default=None,
+        help="Write played videos as JSON lines to TARGET, which is - for stdout, "
+        "unix:PATH for a unix socket or a path of a file",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        default=False,
+        help="Keep history of played videos in a sqlite database",
+    )
+    parser.add_argument(
+        "--archive-path",
+        metavar="PATH",
+        default=None,
+        help="Database of --archive, implies it "
+        "(default: ~/.local/share/mouselounge/history.sqlite3)",
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="ADDRESS",
+        default=None,
+        help="Serve runtime statistics in the prometheus format on ADDRESS, "
+        "which is unix:PATH or [HOST:]PORT (HOST defaults to 127.0.0.1)",
+    )
+    parser.add_argument(
+        "-D",
+        "--daemon",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="SOCKET",
+        help="Daemon mode, other programs can subscribe to the events, ask for "
+        "stats or play videos through the control SOCKET, "
+        "$XDG_RUNTIME_DIR/mouselounge.sock if it isn't given",
+    )
+    parser.add_argument(
+        "--source",
+        action="append",
+        metavar="[NETNS/]INTERFACE[=FILTER]",
+        help="Capture on INTERFACE, in the network namespace NETNS if it's "
+        "given, with its own pcap FILTER instead of the game servers one. "
+        "Can be given many times, events of all the sources get merged",
+    )
+    parser.add_argument(
+        "--fetcher",
+        choices=("tcpdump", "tcpflow"),
+        default=None,
+        help="Capture with this one if it's installed, tcpdump is tried first "
+        "by default",
+    )
+    parser.add_argument(
+        "--capture-process",
+        action="store_true",
+        default=False,
+        help="Capture and decode packets in a separate process, so nothing "
+        "else going on can delay reading them. Every --source gets its own, "
+        "which spreads the decoding over as many cores",
+    )
+    parser.add_argument(
+        "--lag-threshold",
+        type=float,
+        default=250.0,
+        metavar="MS",
+        help="Log the stack of whatever blocks the event loop for longer than "
+        "this, 0 turns it off (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--uvloop",
+        action="store_true",
+        default=False,
+        help="Run on uvloop instead of the asyncio event loop, if it's installed",
+    )
     parser.add_argument(
         "-d",
         "--debug",
@@ -88,34 +235,63 @@ def parse_args():
         default=False,
         help="Debug your stuff with more verbose outputs",
     )
-    args = parser.parse_args()
+    commands = parser.add_subparsers(dest="command")
+    history = commands.add_parser(
+        "history", help="Show the played videos from the --archive database"
+    )
+    history.add_argument(
+        "query",
+        nargs="?",
+        choices=("plays", "top"),
+        default="plays",
+        help="List of plays or the most played videos (default: %(default)s)",
+    )
+    history.add_argument("-n", "--limit", type=int, default=20)
+    history.add_argument(
+        "--since",
+        type=time_arg,
+        help="Unix time, ISO date or relative time like 12h or 7d",
+    )
+    history.add_argument("--until", type=time_arg, help="Same format as --since")
+    history.add_argument(
+        "--posters", action="store_true", help="Top posters instead of videos"
+    )
+    history.add_argument("--video", help="Only plays of this video id")
+    history.add_argument("--archive-path", metavar="PATH", default=argparse.SUPPRESS)
+    client = commands.add_parser(
+        "client", help="Talk to a mouselounge running in the daemon mode"
+    )
+    client.add_argument(
+        "cmd",
+        metavar="COMMAND",
+        help="ping, stats, sources, reload, play URL, subscribe [EVENT...] with "
+        f"events being {', '.join(TOPICS)}, other commands take KEY=VALUE arguments",
+    )
+    client.add_argument("args", nargs="*", metavar="ARG")
+    client.add_argument("--socket", metavar="PATH", default=None)
+    args = parser.parse_args(argv)
+    if getattr(args, "max_quality", None) and LEVEL_NAMES.index(
+        args.max_quality
+    ) > LEVEL_NAMES.index(args.min_quality):
+        parser.error(
+            f"--max-quality {args.max_quality} is worse than "
+            f"--min-quality {args.min_quality}"
+        )
     return args
 
 
-def sigchld_handler(_signum, _frame):
-    """
-    This function makes sure to reap all of the children
-    processes.
-    """
-    while True:
-        try:
-            ret = os.waitpid(-1, os.WNOHANG)
-        except ChildProcessError:
-            return
-        else:
-            if ret[1] >= 0:
-                return
-        sleep(0.1)
-
-
-
 def main():
+    args = parse_args()
+    if args.command == "history":
+        return run_query(args)
+    if args.command == "client":
+        return run_client(args)
+
     for prog in "youtube-dl", "mpv":
         if which(prog) is None:
             print(f"Please install {prog} and try again.", file=sys.stderr)
             sys.exit(1)
 
-    args = parse_args()
     LOGGER.setLevel(logging.DEBUG if args.debug else logging.INFO)
 
     console = logging.StreamHandler()
@@ -126,21 +302,61 @@ def main():
     console.setFormatter(formatter)
     globalog = logging.getLogger()
     globalog.setLevel(logging.ERROR)
-    globalog.addHandler(console)
+    # the console gets written from a thread, never from the loop
+    logs = start_logging(globalog, console)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
     LOGGER.info("Starting up %s", __fulltitle__)
 
-    signal.signal(signal.SIGCHLD, sigchld_handler)
+    signal.signal(signal.SIGUSR1, trace_handler)
     signal.signal(signal.SIGUSR2, debug_handler)
+    # kill -s RTMIN+1 and RTMIN+2 work for these from the shell
+    signal.signal(signal.SIGRTMIN + 1, profile_handler)
+    signal.signal(signal.SIGRTMIN + 2, memory_handler)
 
-    managers = Managers()
-    handler = Handler(managers, args)
-
+    try:
+        listen(args)
+    finally:
+        logs.stop()
+
+
+def setup(api, args):
+    """Hooks the managers up to the loop of the api"""
+    handler = Handler(Managers(), args)
+    handler.add_asyncio_calls(
+        api.loop.call_soon,
+        api.loop.call_later,
+        api.loop.call_soon_threadsafe,
+        api.loop.create_task,
+    )
+    handler.add_scheduler(api.scheduler)
+    api.loop.call_soon(handler.start)
+    api.add_closer(handler.stop)
+    if getattr(args, "daemon", None) is not None:
+        api.control = ControlServer(api, handler, args.daemon or None)
+        api.control.bind()
+
+        def reload_handler():
+            try:
+                handler.reload()
+            except Exception:
+                LOGGER.exception("Failed to reload the managers, keeping the old ones")
+
+        # only for the daemon, anywhere else SIGHUP has to end us when the
+        # terminal goes away. On the loop, so managers get swapped between events
+        api.loop.add_signal_handler(signal.SIGHUP, reload_handler)
+        handler.add_publisher(api.control.publish)
+        # subscribers see the decoded data before the managers act on it
+        api.add_listener("play_vid_tribehouse", api.control.decoded)
+    if handler.community_managers:
+        api.add_listener("play_vid_tribehouse", handler.community_data)
+    return handler
+
+
+def listen(args):
+    """Runs the whole thing until the packet fetcher is done"""
     with Mousapi(args) as api:
-        handler.add_asyncio_calls(api.loop.call_soon, api.loop.call_later)
-        if handler.community_managers:
-            api.add_listener("play_vid_tribehouse", handler.community_data)
+        setup(api, args)
         api.listen()
 
 
@@ -151,6 +367,10 @@ def run():
         sys.exit(1)
     except PacketFetcherError:
         sys.exit(2)
+    except RuntimeError as ex:
+        # what keeps it from starting, like an address that is taken
+        print(ex, file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+"""
+History of the played videos, kept in sqlite
+"""
+import logging
+import os
+import re
+import sqlite3
+
+from contextlib import suppress, closing
+from datetime import datetime
+from queue import Queue, Empty, Full
+from threading import Thread
+from time import monotonic, time
+from weakref import finalize
+
+__all__ = ["Archive", "default_archive_path", "parse_time"]
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT PRIMARY KEY,
+    title TEXT,
+    duration REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS plays (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    room TEXT,
+    video_id TEXT NOT NULL,
+    poster TEXT
+);
+CREATE INDEX IF NOT EXISTS plays_ts ON plays (ts);
+CREATE INDEX IF NOT EXISTS plays_video ON plays (video_id, ts);
+"""
+
+RELATIVE = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$")
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def default_archive_path():
+    base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.path.join(base, "mouselounge", "history.sqlite3")
+
+
+def parse_time(value):
+    """
+    Accepts unix timestamps, ISO dates and things like 12h or 7d ago,
+    raises ValueError for anything else. Numbers are taken as they are.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = RELATIVE.match(value)
+    if match:
+        return time() - float(match.group(1)) * UNITS[match.group(2)]
+    with suppress(ValueError):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class Archive:
+    """
+    Writes are done by a separate thread, which commits everything it got
+    in one transaction every `commit_interval` seconds or `batch_size`
+    events, whichever comes first. Once the database grows over `max_size`
+    bytes the oldest `prune_ratio` of plays gets deleted, sqlite reuses the
+    freed pages so the file stops growing.
+    """
+
+    commit_interval = 1.0
+    batch_size = 512
+    prune_ratio = 0.1
+
+    def __init__(self, path=None, max_size=256 * 2 ** 20):
+        self.path = path or default_archive_path()
+        self.max_size = max_size
+        self.dropped = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._queue = Queue(self.batch_size * 8)
+        # open here, so a broken path blows up right away and not in the thread
+        self._conn = connect(self.path)
+        self._thread = Thread(daemon=True, target=self._writer, name="Archive")
+        self._thread.start()
+        self.__finalizer = finalize(self, self._close)
+
+    def record(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def _writer(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = monotonic() + self.commit_interval
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                batch.append(event)
+            if batch:
+                try:
+                    self._commit(batch)
+                except sqlite3.Error:
+                    LOGGER.exception("Failed to archive %d events", len(batch))
+        self._conn.close()
+
+    def _commit(self, batch):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO videos (video_id, title, duration) "
+                "VALUES (:video_id, :title, :duration) "
+                "ON CONFLICT (video_id) DO UPDATE SET "
+                "title = excluded.title, duration = excluded.duration",
+                batch,
+            )
+            self._conn.executemany(
+                "INSERT INTO plays (ts, room, video_id, poster) "
+                "VALUES (:ts, :room, :video_id, :poster)",
+                batch,
+            )
+        if self.size() > self.max_size:
+            self.prune()
+
+    def size(self):
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def prune(self):
+        with self._conn:
+            count = self._conn.execute("SELECT COUNT(*) FROM plays").fetchone()[0]
+            limit = max(int(count * self.prune_ratio), 1)
+            self._conn.execute(
+                "DELETE FROM plays WHERE id IN "
+                "(SELECT id FROM plays ORDER BY id LIMIT ?)",
+                (limit,),
+            )
+            self._conn.execute(
+                "DELETE FROM videos WHERE video_id NOT IN "
+                "(SELECT DISTINCT video_id FROM plays)"
+            )
+        LOGGER.info("Pruned %d oldest plays from the archive", limit)
+
+    def close(self):
+        self.__finalizer()
+
+    def _close(self, timeout=5.0):
+        with suppress(Full):
+            self._queue.put(None, timeout=timeout)
+        self._thread.join(timeout)
+        if self.dropped:
+            LOGGER.warning("Archive dropped %d events", self.dropped)
+
+
+def _range(since, until):
+    return parse_time(since) or 0.0, parse_time(until) or float("inf")
+
+
+def top(path, limit=10, since=None, until=None, posters=False):
+    """Most played videos or most active posters in the time range"""
+    since, until = _range(since, until)
+    with closing(sqlite3.connect(path)) as conn:
+        if posters:
+            return conn.execute(
+                "SELECT poster, COUNT(*) AS plays FROM plays "
+                "WHERE ts >= ? AND ts <= ? AND poster IS NOT NULL "
+                "GROUP BY poster ORDER BY plays DESC LIMIT ?",
+                (since, until, limit),
+            ).fetchall()
+        return conn.execute(
+            "SELECT p.video_id, v.title, p.plays FROM ("
+            "SELECT video_id, COUNT(*) AS plays FROM plays "
+            "WHERE ts >= ? AND ts <= ? GROUP BY video_id "
+            "ORDER BY plays DESC LIMIT ?) AS p "
+            "LEFT JOIN videos AS v USING (video_id) ORDER BY p.plays DESC",
+            (since, until, limit),
+        ).fetchall()
+
+
+def plays(path, limit=50, since=None, until=None, video_id=None):
+    """Plays in the time range, newest first"""
+    since, until = _range(since, until)
+    query = (
+        "SELECT p.ts, p.room, p.video_id, v.title, p.poster FROM plays AS p "
+        "LEFT JOIN videos AS v USING (video_id) WHERE p.ts >= ? AND p.ts <= ? "
+    )
+    params = [since, until]
+    if video_id:
+        query += "AND p.video_id = ? "
+        params.append(video_id)
+    query += "ORDER BY p.ts DESC LIMIT ?"
+    params.append(limit)
+    with closing(sqlite3.connect(path)) as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def run_query(args):
+    path = args.archive_path or default_archive_path()
+    if not os.path.exists(path):
+        print(f"There is no history in {path} yet.")
+        return 1
+    if args.query == "top":
+        for row in top(path, args.limit, args.since, args.until, args.posters):
+            if args.posters:
+                print(f"{row[1]:>7}  {row[0]}")
+            else:
+                print(f"{row[2]:>7}  {row[0]}  {row[1] or ''}")
+    else:
+        for ts, room, video_id, title, poster in plays(
+            path, args.limit, args.since, args.until, args.video
+        ):
+            when = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{when}  {room:<10}  {video_id}  {title or ''}  {poster or ''}")
+    return 0
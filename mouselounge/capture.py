@@ -0,0 +1,450 @@
+"""
+Packet capture and decoding, either on the main loop or in a separate
+process that hands the decoded events over through shared memory
+"""
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import signal
+import struct
+
+from collections import deque
+from contextlib import suppress
+from multiprocessing.shared_memory import SharedMemory
+from os import devnull
+from shutil import which
+from time import time
+
+from .framing import ChunkFramer, PcapFramer, TcpflowFramer
+from .protocol import ProtocolHandler
+from .stats import STATS
+
+__all__ = [
+    "PacketFetcherError",
+    "PacketFetcherProtocol",
+    "FETCHERS",
+    "fetcher_command",
+    "split_lines",
+    "RingBuffer",
+    "CaptureProcess",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+CAPTURE_BYTES = STATS.counter(
+    "mouselounge_capture_bytes_total", "Bytes read from the packet fetcher"
+)
+CAPTURE_PACKETS = STATS.counter(
+    "mouselounge_capture_packets_total", "Records framed from the fetcher output"
+)
+CAPTURE_LINES = STATS.counter(
+    "mouselounge_capture_lines_total", "Lines yielded for protocol matching"
+)
+
+
+class PacketFetcherError(Exception):
+    def __init__(self, msg=""):
+        super().__init__()
+        self.msg = msg
+
+    def __str__(self):
+        if self.msg:
+            return str(self.msg).strip()
+        return PacketFetcherError.__name__
+
+
+def split_lines(records):
+    """(capture time, line) of every line long enough to hold a value"""
+    for record in records:
+        for line in record.payload.split(b"\n"):
+            if len(line) > 7:
+                CAPTURE_LINES.inc()
+                yield record.ts, line
+
+
+class PacketFetcherProtocol(asyncio.SubprocessProtocol):
+    def __init__(self, loop, framer=None):
+        self.stopped = False
+        self.error_data = str()
+        self._loop = loop
+        self._framer = framer or ChunkFramer()
+        self._chunks = deque()
+        self._waiter = None
+        # done once the fetcher exited and all of its pipes are closed
+        self.closed = loop.create_future()
+
+    def pipe_data_received(self, fd, data):
+        if fd == 1:
+            CAPTURE_BYTES.inc(len(data))
+            self._chunks.append(data)
+            self._wakeup()
+        elif fd == 2:
+            for e in data.decode("utf8").splitlines():
+                self.error_data += f"{e}\n"
+            # tcpflow prints status stuff into stderr so we have to ignore it
+            for status in "listening", "reportfilename":
+                if status in self.error_data.lower() or len(self.error_data) <= 2:
+                    self.error_data = str()
+                    break
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def yielder(self):
+        """
+        Yielding async generator that returns (capture time, bytes) tuples.
+        This function is operable only when tcpdump is run with
+        "-Uw-" arguments or when tcpflow is run with "-cB" arguments.
+        """
+        while not self.stopped or self._chunks:
+            if not self._chunks:
+                self._waiter = self._loop.create_future()
+                try:
+                    await self._waiter
+                except asyncio.CancelledError:
+                    break
+                continue
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            try:
+                records = self._framer.feed(data)
+            except ValueError as ex:
+                raise PacketFetcherError(ex) from ex
+            CAPTURE_PACKETS.inc(len(records))
+            for item in split_lines(records):
+                yield item
+        records = self._framer.flush()
+        CAPTURE_PACKETS.inc(len(records))
+        for item in split_lines(records):
+            yield item
+
+    def pipe_connection_lost(self, _fd, _exc):
+        self.stopped = True
+        self._wakeup()
+
+    def process_exited(self):
+        LOGGER.debug("PacketFetcher game instance exited.")
+        self.stopped = True
+        self._wakeup()
+
+    def connection_lost(self, _exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+FETCHERS = {
+    "tcpdump": (["tcpdump", "-Uw-"], PcapFramer),
+    "tcpflow": (["tcpflow", "-cB", f"-X{devnull}"], TcpflowFramer),
+}
+
+
+def fetcher_command(prefer=None):
+    """
+    Returns the arguments and the framer class of the installed fetcher,
+    `prefer` goes first if it's installed
+    """
+    for name in sorted(FETCHERS, key=lambda name: name != prefer):
+        if which(name):
+            args, framer = FETCHERS[name]
+            return list(args), framer
+    raise RuntimeError(
+        "You don't have a program that can fetch packets!\n"
+        "Install tcpdump or tcpflow and try again!"
+    )
+
+
+class RingBuffer:
+    """
+    Single producer, single consumer ring of length prefixed records in
+    shared memory. The header holds the head and the tail as ever growing
+    byte counts, only the producer moves the head and only the consumer
+    moves the tail, so neither of them needs a lock. Records never wrap
+    around the end, the producer skips the rest of the buffer instead and
+    leaves a marker if there's room for one.
+    """
+
+    header = struct.Struct("QQ")
+    length = struct.Struct("I")
+    wrap = 0xFFFFFFFF
+
+    def __init__(self, capacity=2 ** 20, name=None):
+        self.capacity = capacity
+        self.shm = SharedMemory(
+            name=name, create=name is None, size=self.header.size + capacity
+        )
+        self.buf = self.shm.buf
+        if name is None:
+            self.header.pack_into(self.buf, 0, 0, 0)
+        # struct zeroes what it packs into before it writes the value, the
+        # other end could read that, an item of a cast view is one store
+        self.offsets = self.buf[: self.header.size].cast("Q")
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def pending(self):
+        # the tail never gets past the head that is read after it
+        tail = self.offsets[1]
+        return self.offsets[0] - tail
+
+    @property
+    def head(self):
+        return self.offsets[0]
+
+    @property
+    def tail(self):
+        return self.offsets[1]
+
+    def put(self, data):
+        """Returns False if there's no room for the record"""
+        head, tail = self.offsets
+        need = self.length.size + len(data)
+        pos = head % self.capacity
+        skip = self.capacity - pos if self.capacity - pos < need else 0
+        if head + skip + need - tail > self.capacity:
+            return False
+        offset = self.header.size
+        if skip:
+            if skip >= self.length.size:
+                self.length.pack_into(self.buf, offset + pos, self.wrap)
+            pos = 0
+        start = offset + pos + self.length.size
+        self.length.pack_into(self.buf, offset + pos, len(data))
+        self.buf[start : start + len(data)] = data
+        # publishing the head last makes the record visible to the reader
+        self.offsets[0] = head + skip + need
+        return True
+
+    def get_all(self):
+        """Takes all of the records that are in the ring"""
+        head, tail = self.offsets
+        offset = self.header.size
+        records = []
+        while tail < head:
+            pos = tail % self.capacity
+            rest = self.capacity - pos
+            if rest < self.length.size:
+                tail += rest
+                continue
+            size = self.length.unpack_from(self.buf, offset + pos)[0]
+            if size == self.wrap:
+                tail += rest
+                continue
+            start = offset + pos + self.length.size
+            records.append(bytes(self.buf[start : start + size]))
+            tail += self.length.size + size
+        self.offsets[1] = tail
+        return records
+
+    def close(self, unlink=False):
+        self.offsets.release()
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            with suppress(FileNotFoundError):
+                self.shm.unlink()
+
+
+class _Publisher:
+    """Capture process end of the ring"""
+
+    stats_interval = 1.0
+
+    def __init__(self, loop, ring, fd):
+        self.loop = loop
+        self.ring = ring
+        self.fd = fd
+        self.dropped = 0
+        self._stats = None
+
+    def publish(self, record):
+        head = self.ring.head
+        if not self.ring.put(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)):
+            self.dropped += 1
+            return
+        # the reader only goes to sleep once it caught up with the head, so
+        # it's only the first record after its tail that has to wake it up.
+        # The tail is read after the record is published, a reader that
+        # finds it empty before that moved the tail already.
+        if self.ring.tail == head:
+            # a full pipe means the reader already has wakeups waiting
+            with suppress(BlockingIOError):
+                os.write(self.fd, b"\0")
+
+    def publish_stats(self):
+        self.publish(
+            (
+                "stats",
+                CAPTURE_BYTES.value,
+                CAPTURE_PACKETS.value,
+                CAPTURE_LINES.value,
+                self.dropped,
+            )
+        )
+
+    def _tick(self):
+        self.publish_stats()
+        self._stats = self.loop.call_later(self.stats_interval, self._tick)
+
+    def start(self):
+        self._tick()
+
+    def close(self):
+        if self._stats is not None:
+            self._stats.cancel()
+        self.publish_stats()
+
+
+async def _capture(loop, command, framer, publisher):
+    transport, protocol = await loop.subprocess_exec(
+        lambda: PacketFetcherProtocol(loop, framer()),
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stdin=None,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    protohandler = ProtocolHandler()
+    error = None
+    publisher.start()
+    try:
+        async for ts, line in protocol.yielder():
+            for key, data in protohandler.decode(line):
+                publisher.publish(("event", key, data, ts, time()))
+    except PacketFetcherError as ex:
+        error = str(ex)
+    finally:
+        with suppress(ProcessLookupError):
+            transport.terminate()
+        transport.close()
+        publisher.close()
+    error = error or protocol.error_data
+    if error:
+        publisher.publish(("error", error))
+    publisher.publish(("done",))
+
+
+def _capture_main(command, framer, ring_name, capacity, conn):
+    # Ctrl+C reaches the whole process group, we end when the fetcher does
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGQUIT, signal.SIG_IGN)
+    ring = RingBuffer(capacity, ring_name)
+    fd = conn.fileno()
+    os.set_blocking(fd, False)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    publisher = _Publisher(loop, ring, fd)
+    try:
+        loop.run_until_complete(_capture(loop, command, framer, publisher))
+    finally:
+        loop.close()
+        ring.close()
+        conn.close()
+
+
+class CaptureProcess:
+    """
+    Runs the fetcher and the protocol decoding in a separate process, so
+    nothing on the main loop can hold up the pipe reads. Decoded events
+    come back through a `RingBuffer`, a byte in a pipe wakes the loop up
+    when the ring goes from empty to not empty. The process closing its
+    end of the pipe means the capture is over.
+    """
+
+    capacity = 4 * 2 ** 20
+
+    def __init__(self, loop, command, framer):
+        self.loop = loop
+        self.command = command
+        self.framer = framer
+        self.stopped = False
+        self.done = False
+        self.error_data = str()
+        self.ring = None
+        self.process = None
+        self._conn = None
+        self._waiter = None
+        self._seen = (0, 0, 0, 0)
+        self.dropped = STATS.counter(
+            "mouselounge_capture_ring_dropped_total",
+            "Decoded events that didn't fit in the capture ring",
+        )
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.ring = RingBuffer(self.capacity)
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=_capture_main,
+            args=(self.command, self.framer, self.ring.name, self.capacity, child_conn),
+            name="mouselounge-capture",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.loop.add_reader(self._conn.fileno(), self._readable)
+        LOGGER.debug("Capture process %d started", self.process.pid)
+
+    def _readable(self):
+        try:
+            data = os.read(self._conn.fileno(), 4096)
+        except BlockingIOError:
+            return
+        if not data:
+            self.loop.remove_reader(self._conn.fileno())
+            self.stopped = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _stats(self, *values):
+        # the counters of the other process only ever grow, so the
+        # difference since its previous stats is what's new
+        counters = CAPTURE_BYTES, CAPTURE_PACKETS, CAPTURE_LINES, self.dropped
+        for counter, value, seen in zip(counters, values, self._seen):
+            counter.inc(value - seen)
+        self._seen = values
+
+    async def events(self):
+        """Yields (key, data, capture time, decode time) tuples"""
+        while True:
+            records = self.ring.get_all()
+            if not records:
+                if self.stopped:
+                    break
+                self._waiter = self.loop.create_future()
+                try:
+                    await self._waiter
+                except asyncio.CancelledError:
+                    break
+                continue
+            for record in records:
+                kind, *rest = pickle.loads(record)
+                if kind == "event":
+                    yield tuple(rest)
+                elif kind == "stats":
+                    self._stats(*rest)
+                elif kind == "error":
+                    self.error_data += rest[0]
+                elif kind == "done":
+                    self.done = True
+        if not self.done and not self.error_data:
+            self.error_data = "Capture process exited unexpectedly"
+
+    def close(self, timeout=2.0):
+        if self._conn is not None:
+            with suppress(ValueError):
+                self.loop.remove_reader(self._conn.fileno())
+            self._conn.close()
+            self._conn = None
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process.join(timeout)
+            self.process = None
+        if self.ring is not None:
+            self.ring.close(unlink=True)
+            self.ring = None
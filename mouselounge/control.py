@@ -0,0 +1,269 @@
+"""
+Control socket of the daemon mode, one JSON object per line both ways.
+
+Requests look like {"id": 1, "cmd": "stats"} and get a reply with the
+same id, {"id": 1, "ok": true, "data": ...} or {"id": 1, "ok": false,
+"error": "..."}. After subscribing, events come as {"event": topic, ...}
+lines. Every client has a bounded queue, clients that can't keep up get
+disconnected, so nobody can hold up the capture.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+
+from contextlib import suppress
+from tempfile import gettempdir
+from time import time
+
+from .stats import STATS
+from .tracing import Trace, Traced
+
+__all__ = ["TOPICS", "ControlServer", "default_socket_path", "run_client"]
+
+LOGGER = logging.getLogger(__name__)
+
+# decoded is every piece of data the protocol handler gave us,
+# video is every video the managers went on to play or show
+TOPICS = ("decoded", "video")
+
+
+def default_socket_path():
+    base = os.environ.get("XDG_RUNTIME_DIR") or gettempdir()
+    return os.path.join(base, "mouselounge.sock")
+
+
+def _encode(msg):
+    return f"{json.dumps(msg, default=str)}\n".encode("utf8")
+
+
+class _Client:
+    def __init__(self, reader, writer, maxsize):
+        self.reader = reader
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize)
+        self.topics = set()
+        self.sender = None
+        self.handler = asyncio.current_task()
+
+    async def send_queued(self):
+        while True:
+            line = await self.queue.get()
+            self.writer.write(line)
+            await self.writer.drain()
+
+
+class ControlServer:
+    """
+    Commands are the cmd_* methods, each one takes the request and
+    returns the data of the reply or raises ValueError.
+    """
+
+    queue_size = 256
+
+    def __init__(self, api, handler, path=None):
+        self.api = api
+        self.handler = handler
+        self.path = path or default_socket_path()
+        self.clients = set()
+        self.server = None
+        self.disconnected = STATS.counter(
+            "mouselounge_control_slow_disconnects_total",
+            "Subscribers disconnected for not keeping up",
+        )
+        self.published = STATS.counter(
+            "mouselounge_control_events_total", "Events published to subscribers"
+        )
+        STATS.gauge(
+            "mouselounge_control_clients",
+            "Clients connected to the control socket",
+            self.clients.__len__,
+        )
+
+    def _claim_path(self):
+        with suppress(FileNotFoundError, ConnectionRefusedError), socket.socket(
+            socket.AF_UNIX
+        ) as probe:
+            probe.connect(self.path)
+            raise RuntimeError(f"Another daemon already listens on {self.path}")
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def bind(self):
+        """
+        Takes over the socket before the loop runs, so a daemon that can't
+        have it fails to start, raises RuntimeError then
+        """
+        # a chmod after the bind would leave a window for anyone to connect
+        umask = os.umask(0o077)
+        try:
+            self._claim_path()
+            self.server = self.api.loop.run_until_complete(
+                asyncio.start_unix_server(self._client, self.path)
+            )
+        except OSError as ex:
+            raise RuntimeError(f"Can't listen on {self.path}: {ex}") from ex
+        finally:
+            os.umask(umask)
+        LOGGER.info("Control socket listening on %s", self.path)
+
+    async def serve(self, finished):
+        """Serves until `finished` is set"""
+        try:
+            async with self.server:
+                await finished.wait()
+        finally:
+            handlers = [c.handler for c in self.clients if c.handler is not None]
+            for client in list(self.clients):
+                self._drop(client)
+            # closed connections end their handlers on their own
+            if handlers:
+                await asyncio.wait(handlers, timeout=1.0)
+            with suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    async def _client(self, reader, writer):
+        client = _Client(reader, writer, self.queue_size)
+        client.sender = asyncio.ensure_future(client.send_queued())
+        self.clients.add(client)
+        try:
+            while line := await reader.readline():
+                self._request(client, line)
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self._drop(client)
+
+    def _drop(self, client):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        client.sender.cancel()
+        # close() would wait for the peer to read what's buffered
+        with suppress(Exception):
+            client.writer.transport.abort()
+
+    def _put(self, client, line):
+        try:
+            client.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.disconnected.inc()
+            LOGGER.warning("Disconnecting a control client that can't keep up")
+            self._drop(client)
+            return False
+        return True
+
+    def _request(self, client, line):
+        if not line.strip():
+            return
+        request = None
+        try:
+            request = json.loads(line)
+            cmd = getattr(self, f"cmd_{request.get('cmd')}", None)
+            if cmd is None:
+                raise ValueError(f"Unknown command {request.get('cmd')!r}")
+            reply = {"ok": True, "data": cmd(client, request)}
+        except (ValueError, AttributeError, TypeError) as ex:
+            reply = {"ok": False, "error": str(ex)}
+        except Exception as ex:
+            LOGGER.exception("Control command failed: %s", line)
+            reply = {"ok": False, "error": str(ex)}
+        if isinstance(request, dict) and "id" in request:
+            reply["id"] = request["id"]
+        self._put(client, _encode(reply))
+
+    def publish(self, topic, payload):
+        line = None
+        for client in list(self.clients):
+            if topic not in client.topics:
+                continue
+            if line is None:
+                line = _encode(dict(payload, event=topic))
+            if self._put(client, line):
+                self.published.inc()
+
+    def decoded(self, data):
+        """Listener for the decoded protocol data"""
+        if self.clients:
+            trace = getattr(data, "trace", None)
+            ts = trace.stamps["capture"] if trace is not None else time()
+            self.publish("decoded", {"ts": ts, "data": list(data)})
+        return True
+
+    @staticmethod
+    def cmd_ping(_client, _request):
+        return "pong"
+
+    @staticmethod
+    def cmd_subscribe(client, request):
+        topics = request.get("events") or TOPICS
+        unknown = set(topics) - set(TOPICS)
+        if unknown:
+            raise ValueError(f"Unknown events {', '.join(sorted(unknown))}")
+        client.topics.update(topics)
+        return sorted(client.topics)
+
+    @staticmethod
+    def cmd_unsubscribe(client, request):
+        client.topics.difference_update(request.get("events") or TOPICS)
+        return sorted(client.topics)
+
+    @staticmethod
+    def cmd_stats(_client, _request):
+        return STATS.snapshot()
+
+    def cmd_sources(self, _client, _request):
+        return self.api.sources.health()
+
+    def cmd_reload(self, _client, _request):
+        return self.handler.reload()
+
+    def cmd_play(self, _client, request):
+        url = request.get("url")
+        if not url:
+            raise ValueError("play needs an url")
+        if not self.handler.community_managers:
+            raise ValueError("There are no managers that could play it")
+        # same way as if somebody posted it
+        return self.handler.community_data(Traced((url,), Trace()))
+
+
+def run_client(args):
+    """Sends one command to the daemon and prints what comes back"""
+    request = {"id": 1, "cmd": args.cmd}
+    if args.cmd in ("subscribe", "unsubscribe"):
+        request["events"] = args.args
+    elif args.cmd == "play":
+        if not args.args:
+            print("play needs an url", file=sys.stderr)
+            return 1
+        request["url"] = args.args[0]
+    else:
+        for arg in args.args:
+            key, _, value = arg.partition("=")
+            request[key] = value
+    path = args.socket or default_socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(_encode(request))
+            with sock.makefile("r", encoding="utf8") as lines:
+                for line in lines:
+                    msg = json.loads(line)
+                    if "event" in msg:
+                        print(line, end="", flush=True)
+                        continue
+                    if not msg.get("ok"):
+                        print(msg.get("error"), file=sys.stderr)
+                        return 1
+                    if args.cmd != "subscribe":
+                        print(json.dumps(msg.get("data"), indent=2))
+                        return 0
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No daemon listens on {path}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -0,0 +1,196 @@
+"""
+Turning the raw output of the packet fetchers into records
+"""
+import logging
+import re
+import struct
+
+from collections import namedtuple
+from time import time
+
+__all__ = [
+    "Record",
+    "PcapFramer",
+    "TcpflowFramer",
+    "ChunkFramer",
+    "flow_name",
+    "tcp_payload",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+# ts is the capture time in seconds since the epoch, flow is the
+# connection the payload came from if the fetcher tells us that
+Record = namedtuple("Record", ("ts", "payload", "flow"), defaults=(None,))
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAP_HEADER_SIZE = 24
+
+# size of the link layer header for the link types tcpdump may use,
+# frames of any other type are left as they are
+LINK_HEADERS = {0: 4, 1: 14, 12: 0, 101: 0, 113: 16, 276: 20}
+ETHERTYPE_VLAN = 0x8100
+
+# flow names tcpflow puts in front of every packet with -c, zero padded
+# ipv4 addresses and ports of the source and the destination
+FLOW_HEADER = re.compile(
+    rb"(\d{3}\.\d{3}\.\d{3}\.\d{3}\.\d{5}-\d{3}\.\d{3}\.\d{3}\.\d{3}\.\d{5}): "
+)
+
+
+def flow_name(src, sport, dst, dport):
+    """The way tcpflow names the flows"""
+
+    def end(addr, port):
+        return ".".join(f"{octet:03d}" for octet in addr) + f".{port:05d}"
+
+    return f"{end(src, sport)}-{end(dst, dport)}"
+
+
+def tcp_payload(frame, link, names=None):
+    """
+    Flow and payload of a tcp over ipv4 frame, None and the frame
+    otherwise. `names` caches the flow names by their addresses and ports.
+    """
+    offset = LINK_HEADERS.get(link)
+    if offset is None:
+        return None, frame
+    if link == 1 and frame[12:14] == ETHERTYPE_VLAN.to_bytes(2, "big"):
+        offset += 4
+    try:
+        if frame[offset] >> 4 != 4 or frame[offset + 9] != 6:
+            return None, frame
+        tcp = offset + (frame[offset] & 0x0F) * 4
+        start = tcp + (frame[tcp + 12] >> 4) * 4
+    except IndexError:
+        return None, frame
+    ends = frame[offset + 12 : offset + 20] + frame[tcp : tcp + 4]
+    if len(ends) < 12:
+        return None, frame
+    name = names.get(ends) if names is not None else None
+    if name is None:
+        sport, dport = struct.unpack_from(">HH", ends, 8)
+        name = flow_name(ends[:4], sport, ends[4:8], dport)
+        if names is not None:
+            if len(names) > 4096:
+                names.clear()
+            names[ends] = name
+    return name, frame[start:]
+
+
+class PcapFramer:
+    """
+    Incremental parser of the pcap stream tcpdump writes with -w-.
+    `feed` takes whatever came from the pipe and returns the records that
+    are complete, the rest stays buffered until the next call. Records of
+    tcp over ipv4 are just the tcp payload, same as what tcpflow gives us.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._record = None
+        self._resolution = None
+        self._link = None
+        self._names = {}
+
+    def feed(self, data):
+        self._buffer += data
+        records = []
+        offset = 0
+        if self._record is None:
+            if len(self._buffer) < PCAP_HEADER_SIZE:
+                return records
+            try:
+                endian, self._resolution = PCAP_MAGIC[bytes(self._buffer[:4])]
+            except KeyError:
+                raise ValueError("Fetcher output is not a pcap stream") from None
+            self._record = struct.Struct(f"{endian}IIII")
+            self._link = struct.unpack_from(f"{endian}I", self._buffer, 20)[0] & 0xFFFF
+            offset = PCAP_HEADER_SIZE
+        header = self._record
+        end = len(self._buffer)
+        while offset + header.size <= end:
+            sec, frac, incl_len, _orig_len = header.unpack_from(self._buffer, offset)
+            start = offset + header.size
+            if start + incl_len > end:
+                break
+            flow, payload = tcp_payload(
+                bytes(self._buffer[start : start + incl_len]), self._link, self._names
+            )
+            records.append(Record(sec + frac * self._resolution, payload, flow))
+            offset = start + incl_len
+        del self._buffer[:offset]
+        return records
+
+    @staticmethod
+    def flush():
+        # an incomplete record at the end is of no use
+        return []
+
+
+class TcpflowFramer:
+    """
+    Parser of what tcpflow -cB prints, every packet is the name of its
+    flow, ": ", the payload and a newline. The payload ends where the
+    header of the next packet starts. A payload that doesn't end with
+    the newline yet is still being written, it stays buffered until
+    the rest comes, so no packet gets split between two records.
+    Everything is stamped with the time it was read.
+    """
+
+    max_pending = 2 ** 20
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.flow = None
+
+    def _record(self, now, payload):
+        if payload.endswith(b"\n"):
+            payload = payload[:-1]
+        return Record(now, bytes(payload), self.flow)
+
+    def feed(self, data):
+        self._buffer += data
+        buffer = self._buffer
+        now = time()
+        records = []
+        pos = 0
+        for match in FLOW_HEADER.finditer(buffer):
+            if match.start() > pos:
+                records.append(self._record(now, buffer[pos : match.start()]))
+            self.flow = match.group(1).decode("ascii")
+            pos = match.end()
+        if buffer.endswith(b"\n") or len(buffer) - pos > self.max_pending:
+            if len(buffer) > pos:
+                records.append(self._record(now, buffer[pos:]))
+            pos = len(buffer)
+        del buffer[:pos]
+        return records
+
+    def flush(self):
+        """Whatever is left once the fetcher is gone"""
+        if not self._buffer:
+            return []
+        records = [self._record(time(), self._buffer)]
+        self._buffer = bytearray()
+        return records
+
+
+class ChunkFramer:
+    """
+    For fetchers that don't give us any framing or timestamps, every
+    chunk from the pipe is a record stamped with the time it was read.
+    """
+
+    @staticmethod
+    def feed(data):
+        return [Record(time(), data)]
+
+    @staticmethod
+    def flush():
+        return []
@@ -27,12 +27,12 @@ import logging
 import os
 import sys
 
-from importlib import import_module
+from contextlib import suppress
+from importlib import import_module, reload
+from time import perf_counter
 
-# pylint: disable=unused-wildcard-import,wildcard-import
-from .managers import *
-
-# pylint: enable=unused-wildcard-import,wildcard-import
+from .processor import PROCESSOR
+from .stats import STATS
 
 # Stuff cwd into python path
 sys.path.insert(0, os.getcwd())
@@ -41,76 +41,128 @@ __all__ = ["Managers", "Handler"]
 
 LOGGER = logging.getLogger(__name__)
 
+RELOADS = STATS.counter(
+    "mouselounge_manager_reloads_total", "Times the managers got reloaded"
+)
+RELOAD_SECONDS = STATS.gauge(
+    "mouselounge_manager_reload_seconds",
+    "How long the last reload of the managers took",
+)
+
 
 class Managers(list):
-    def __init__(self, additional=None):
+    """
+    Manager classes of the managers package and the `additional` modules.
+    With `reload` the modules get imported again first, the package after
+    its submodules, so it picks up the new classes.
+    """
+
+    def __init__(self, additional=None, reload_modules=False):
         super().__init__()
+        self.additional = additional
+        self.package = import_module(".managers", __package__)
+        if reload_modules:
+            prefix = f"{self.package.__name__}."
+            for name in [name for name in sys.modules if name.startswith(prefix)]:
+                reload(sys.modules[name])
+            self.package = reload(self.package)
         if additional is not None:
             for cmd in additional:
                 try:
                     mod = import_module(cmd)
+                    if reload_modules:
+                        mod = reload(mod)
                     for cand in mod.__dict__.values():
                         if not self.valid(cand):
                             continue
                         self += (cand,)
                 except ImportError:
                     LOGGER.exception("Failed to import custom command")
-        for cand in globals().values():
+        for cand in vars(self.package).values():
             if not self.valid(cand):
                 continue
             self += (cand,)
         LOGGER.debug("Managers: %s", ", ".join(c.__name__ for c in self))
 
-    @staticmethod
-    def valid(cand):
-        if cand is HelperManager:
+    def valid(self, cand):
+        pkg = self.package
+        if cand is pkg.HelperManager:
             return True
-        if not inspect.isclass(cand) or not issubclass(cand, BaseManager):
+        if not inspect.isclass(cand) or not issubclass(cand, pkg.BaseManager):
             return False
-        if cand is CommunityManager or cand is GameManager or cand is BaseManager:
+        if cand in (pkg.CommunityManager, pkg.GameManager, pkg.BaseManager):
             return False
         return True
 
 
 class Handler:
     def __init__(self, manager_candidates, args):
+        self.args = args
+        self.additional = manager_candidates.additional
+        self.calls = ()
+        self.scheduler = None
+        self.publish = None
+        (
+            self.community_managers,
+            self.game_managers,
+            self.helper_manager,
+        ) = self.instantiate(manager_candidates)
+        if self.community_managers:
+            LOGGER.debug(
+                "Initialized community managers %s",
+                ", ".join(repr(h) for h in self.community_managers),
+            )
+        if self.game_managers:
+            LOGGER.debug(
+                "Initialized game managers %s",
+                ", ".join(repr(h) for h in self.game_managers),
+            )
+
+    def instantiate(self, manager_candidates, previous=None):
+        """
+        Returns (community managers, game managers, helper manager), every
+        manager gets the one it replaces, if any, as `previous`
+        """
+        pkg = manager_candidates.package
+        previous = previous or {}
         community_managers = []
         game_managers = []
         helper_manager = None
         for cand in manager_candidates:
             try:
-                inst = cand(args=args)
-                if issubclass(cand, CommunityManager):
+                if cand is pkg.HelperManager:
+                    helper_manager = cand
+                    continue
+                inst = cand(args=self.args, previous=previous.get(cand.__name__))
+                if issubclass(cand, pkg.CommunityManager):
                     community_managers += (inst,)
-                if issubclass(cand, GameManager):
+                if issubclass(cand, pkg.GameManager):
                     game_managers += (inst,)
-                if cand is HelperManager:
-                    helper_manager = cand
             except Exception:
                 LOGGER.exception("Failed to initialize managers %s", str(cand))
 
         def sort(self):
             return self.__class__.__name__
 
-        self.community_managers = sorted(community_managers, key=sort)
-        self.game_managers = sorted(game_managers, key=sort)
-        self.helper_manager = helper_manager
-        if self.community_managers:
-            LOGGER.debug(
-                "Initialized community managers %s",
-                ", ".join(repr(h) for h in self.community_managers),
-            )
-        if self.game_managers:
-            LOGGER.debug(
-                "Initialized game managers %s",
-                ", ".join(repr(h) for h in self.game_managers),
-            )
+        return (
+            sorted(community_managers, key=sort),
+            sorted(game_managers, key=sort),
+            helper_manager,
+        )
+
+    @property
+    def managers(self):
+        """Every manager once, even the ones that are in both lists"""
+        return list(
+            {id(m): m for m in self.community_managers + self.game_managers}.values()
+        )
 
     def add_asyncio_calls(self, *calls):
         """
         Every asyncio function will be added to both managers with its
         original name.
         """
+        self.calls += calls
         # for manager in self.community_managers + self.game_managers:
         try:
             for c in calls:
@@ -118,7 +170,98 @@ class Handler:
         except Exception:
             LOGGER.exception("Failed to add asyncio call: %s", c.__name__)
 
+    def add_scheduler(self, scheduler):
+        """All the managers share the scheduler of the api loop"""
+        self.scheduler = scheduler
+        self.helper_manager.scheduler = scheduler
+
+    def add_publisher(self, publish):
+        """Events the managers publish go to the control socket subscribers"""
+        self.publish = publish
+        self.helper_manager.publish = publish
+
+    def _equip(self, helper_manager):
+        """Gives a reloaded helper manager what the old one got added"""
+        for c in self.calls:
+            setattr(helper_manager, c.__name__, c)
+        if self.scheduler is not None:
+            helper_manager.scheduler = self.scheduler
+        if self.publish is not None:
+            helper_manager.publish = self.publish
+
+    def reload(self):
+        """
+        Imports the manager modules again and swaps in new instances of
+        the managers, the new ones take over what the old ones had running
+        once all of them got constructed. Managers that are gone get stopped.
+        Nothing changes if an import fails, a manager that fails to construct
+        keeps its old instance. Has to run on the loop, it swaps the managers
+        between events.
+        """
+        started = perf_counter()
+        candidates = Managers(self.additional, reload_modules=True)
+        old = self.managers
+        # the new managers might need them already in their __init__
+        self.helper_manager = candidates.package.HelperManager
+        self._equip(self.helper_manager)
+        previous = {type(m).__name__: m for m in old}
+        community, game, _ = self.instantiate(candidates, previous)
+        new = {id(m): m for m in community + game}
+        for manager in new.values():
+            replaced = previous.get(type(manager).__name__)
+            if replaced is not None:
+                try:
+                    manager.take_over(replaced)
+                except Exception:
+                    LOGGER.exception("Failed to hand %s over", replaced)
+        # the old version keeps running if the new one can't be initialized
+        failed = {c.__name__ for c in candidates} - {
+            type(m).__name__ for m in new.values()
+        }
+        self.community_managers = sorted(
+            community
+            + [m for m in self.community_managers if type(m).__name__ in failed],
+            key=lambda m: m.__class__.__name__,
+        )
+        self.game_managers = sorted(
+            game + [m for m in self.game_managers if type(m).__name__ in failed],
+            key=lambda m: m.__class__.__name__,
+        )
+        kept = {type(m).__name__ for m in self.managers}
+        for manager in old:
+            if type(manager).__name__ not in kept:
+                try:
+                    manager.on_stop()
+                except Exception:
+                    LOGGER.exception("Failed to stop manager %s", manager)
+        self.start(new.values())
+        elapsed = perf_counter() - started
+        RELOADS.inc()
+        RELOAD_SECONDS.set(elapsed)
+        names = sorted(type(m).__name__ for m in new.values())
+        LOGGER.info(
+            "Reloaded managers %s in %.1f ms", ", ".join(names), elapsed * 1000
+        )
+        return {"seconds": elapsed, "managers": names}
+
+    def start(self, managers=None):
+        for manager in self.managers if managers is None else managers:
+            try:
+                manager.on_start()
+            except Exception:
+                LOGGER.exception("Failed to start manager %s", manager)
+
+    def stop(self):
+        for manager in self.managers:
+            try:
+                manager.on_stop()
+            except Exception:
+                LOGGER.exception("Failed to stop manager %s", manager)
+        PROCESSOR.close()
+
     def community_data(self, data):
+        with suppress(AttributeError):
+            data.trace.stamp("dispatch")
         for manager in self.community_managers:
             try:
                 manager.handle_data(data)
@@ -130,6 +273,8 @@ class Handler:
         return True
 
     def game_data(self, data):
+        with suppress(AttributeError):
+            data.trace.stamp("dispatch")
         for manager in self.game_managers:
             try:
                 manager.handle_data(data)
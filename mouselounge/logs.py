@@ -0,0 +1,103 @@
+"""
+Logging that stays off the loop thread. Records go into a bounded queue
+and a listener thread formats and writes them, whatever doesn't fit in
+the queue gets dropped and counted instead of blocking.
+"""
+import logging
+import queue
+
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+from .stats import STATS
+
+__all__ = ["Payload", "RateLimit", "DroppingQueueHandler", "start_logging"]
+
+DROPPED = STATS.counter(
+    "mouselounge_log_dropped_total", "Log records dropped because the queue was full"
+)
+SUPPRESSED = STATS.counter(
+    "mouselounge_log_suppressed_total", "Log records suppressed by the rate limit"
+)
+
+
+class Payload:
+    """
+    Packet bytes for log arguments, only `limit` bytes of them get
+    formatted and only if the record is actually written
+    """
+
+    __slots__ = ("data", "limit")
+
+    def __init__(self, data, limit=64):
+        self.data = data
+        self.limit = limit
+
+    def __str__(self):
+        if len(self.data) <= self.limit:
+            return repr(self.data)
+        return f"{self.data[: self.limit]!r}... ({len(self.data)} bytes)"
+
+    __repr__ = __str__
+
+
+class RateLimit(logging.Filter):
+    """
+    Token bucket for every logger, `burst` records at once and `rate`
+    per second after that. The first record let through after some got
+    suppressed says how many.
+    """
+
+    def __init__(self, rate=20.0, burst=100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def filter(self, record):
+        now = monotonic()
+        tokens, last, suppressed = self.buckets.get(record.name, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[record.name] = tokens, now, suppressed + 1
+            SUPPRESSED.inc()
+            return False
+        if suppressed:
+            record.msg = f"{record.msg}\n({suppressed} more records were suppressed)"
+        self.buckets[record.name] = tokens - 1, now, 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Doesn't format anything, the listener thread does that. Arguments
+    of the records must not change after they're logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+def start_logging(logger, *handlers, size=10000, rate=20.0, burst=100):
+    """
+    Puts the queue in front of `handlers` and attaches it to `logger`.
+    Returns the QueueListener, stopping it writes what's left in the queue.
+    """
+    records = queue.Queue(size)
+    STATS.gauge(
+        "mouselounge_log_queue_depth",
+        "Log records waiting to be written",
+        records.qsize,
+    )
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(RateLimit(rate, burst))
+    logger.addHandler(handler)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
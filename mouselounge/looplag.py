@@ -0,0 +1,126 @@
+"""
+Measures how late the event loop runs its callbacks
+"""
+import asyncio
+import logging
+import threading
+import sys
+import traceback
+
+from time import monotonic
+
+from .stats import STATS
+from .tracing import Histogram
+
+__all__ = ["LagMonitor", "LAG", "new_event_loop"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LagMonitor:
+    """
+    A callback asks to be called again in `interval` seconds and records
+    how much later than that it actually ran. A watchdog thread notices
+    when the callback hasn't run for `threshold` seconds past its time,
+    and logs the stack of the loop thread, which shows what's blocking it.
+    Every stall gets logged once.
+    """
+
+    interval = 0.1
+    threshold = 0.25
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.loop = None
+        self.beat = 0.0
+        self._expected = None
+        self._handle = None
+        self._loop_thread = None
+        self._stop = threading.Event()
+        self._watchdog = None
+        self.stalls = STATS.counter(
+            "mouselounge_loop_stalls_total",
+            "Times the loop was blocked past the threshold",
+        )
+        for quantile in 50, 90, 99:
+            STATS.gauge(
+                "mouselounge_loop_lag_seconds",
+                "How late the loop runs its callbacks",
+                lambda q=quantile: self.histogram.percentile(q) / 1000,
+                quantile=str(quantile / 100),
+            )
+
+    def start(self, loop, threshold=None):
+        """Call from the thread that runs `loop`, before or while it runs"""
+        if threshold is not None:
+            self.threshold = threshold
+        self.loop = loop
+        self.histogram = Histogram()
+        self._expected = None
+        self._loop_thread = threading.get_ident()
+        self.beat = monotonic()
+        self._handle = loop.call_soon(self._tick)
+        if self.threshold > 0:
+            self._stop.clear()
+            self._watchdog = threading.Thread(
+                daemon=True, target=self._watch, name="LagWatchdog"
+            )
+            self._watchdog.start()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._watchdog is not None:
+            self._stop.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _tick(self):
+        now = self.loop.time()
+        # the first call only tells us the loop has started
+        if self._expected is not None:
+            self.histogram.record(max(now - self._expected, 0.0))
+        self._expected = now + self.interval
+        self.beat = monotonic()
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.threshold / 4):
+            beat = self.beat
+            late = monotonic() - beat - self.interval
+            if late < self.threshold or beat == reported or not self.loop.is_running():
+                continue
+            reported = beat
+            self.stalls.inc()
+            # pylint: disable=protected-access
+            frame = sys._current_frames().get(self._loop_thread)
+            # pylint: enable=protected-access
+            if frame is None:
+                continue
+            LOGGER.warning(
+                "Loop blocked for %.0f ms so far, it's at:\n%s",
+                late * 1000,
+                "".join(traceback.format_stack(frame)).rstrip(),
+            )
+
+    def dump(self):
+        return f"Loop lag: {self.histogram}, stalls: {self.stalls.value}"
+
+
+def new_event_loop(use_uvloop=False):
+    """The uvloop one if it's asked for and installed, stock one otherwise"""
+    if use_uvloop:
+        try:
+            # pylint: disable=import-outside-toplevel
+            import uvloop
+        except ImportError:
+            LOGGER.warning("uvloop isn't installed, using the asyncio loop")
+        else:
+            LOGGER.info("Using uvloop %s", uvloop.__version__)
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+LAG = LagMonitor()
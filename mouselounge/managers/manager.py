@@ -5,6 +5,9 @@ __all__ = ["HelperManager", "BaseManager", "CommunityManager", "GameManager"]
 
 
 class HelperManager:
+    # Scheduler of the api loop, this will be added during runtime
+    scheduler = None
+
     def __init__(self, **kw):
         self.feedmode = kw.get("args").feedmode
 
@@ -21,11 +24,44 @@ class HelperManager:
         This method will be added during runtime
         """
 
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        This method will be added during runtime
+        """
+
+    def create_task(self, coro):
+        """
+        This method will be added during runtime
+        """
+
+    def publish(self, topic, payload):
+        """
+        This method will be added during runtime, if there is
+        a control socket
+        """
+
 
 class BaseManager:
+    """
+    When the managers get reloaded, the new instance gets the one it
+    replaces as `previous`, which keeps running until every new manager
+    got constructed, `__init__` must leave it alone. `take_over` is where
+    the new one takes over whatever that one has running, the replaced
+    instance doesn't get `on_stop`.
+    """
+
     def __init__(self, **kw):
         self.args = kw.get("args")
 
+    def take_over(self, previous):
+        """Called on a reload, once all the new managers got constructed"""
+
+    def on_start(self):
+        """Called once the api loop is running, or the manager got reloaded"""
+
+    def on_stop(self):
+        """Called on shutdown, before the tasks get cancelled"""
+
 
 class CommunityManager(BaseManager):
     def handle_data(self, data):
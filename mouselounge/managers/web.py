@@ -25,29 +25,49 @@ THE SOFTWARE.
 from time import time
 from time import strftime
 from time import localtime
-from threading import Timer
+from datetime import timedelta
+from contextlib import suppress
 
 import logging
 import html
 import re
 import os
+import sys
 
+from collections import deque
 
-from colorama import init, Fore  # , Back, Style
+
+from colorama import Fore  # , Back, Style
 from cachetools import LRUCache
 
 import isodate
 
 
-from ..utils import get_text, u8str, MPV_IPC_Client
+from ..utils import get_text, u8str, Video, MPV_IPC_Client
+from ..streams import StreamResolver
+from ..mediacache import MediaCache
+from ..quality import QualityController
+from ..sink import EventSink
+from ..archive import Archive
+from ..tracing import TRACER
+from ..stats import STATS
+from ..terminal import Renderer
 from .manager import HelperManager, CommunityManager, GameManager
 
-init(autoreset=True)
-
 __all__ = ["XYoutuberCommunityManager"]
 
 LOGGER = logging.getLogger(__name__)
 
+COOLDOWN_HITS = STATS.counter(
+    "mouselounge_cooldown_hits_total", "Links ignored because of the cooldown"
+)
+METADATA_HITS = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="metadata", result="hit"
+)
+METADATA_MISSES = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="metadata", result="miss"
+)
+
 
 class WebManager(HelperManager):
     # class WebManager(BaseManager, MPV_IPC_Client):
@@ -56,71 +76,267 @@ class WebManager(HelperManager):
     duration = re.compile(r'itemprop="duration"\s+content="(.+?)"', re.M | re.S)
     title = re.compile(r'itemprop="name"\s+content="(.+?)"', re.M | re.S)
     # needle = re.compile("^$"), 0
-    cooldown = LRUCache(maxsize=10)
     timeout = 60
     mpv_idle_timeout = 30.0 * 60.0
+    # mpv falls back to its ytdl hook if we couldn't resolve the stream by then
+    resolve_timeout = 15.0
+    ytdl_format = "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/webm/mp4/best"
+    # how often adaptive quality looks at the cpu and mpv stats
+    quality_interval = 10.0
+    # append the next queued video to mpv's playlist that long before the end
+    preload_ahead = 30.0
+    # single file formats, so the media cache doesn't need ffmpeg for merging
+    cache_format = "best[height<=720][ext=mp4]/best[height<=720]/best"
 
     def __init__(self, **kw):
         super().__init__(**kw)
-        self.mpvc = MPV_IPC_Client()
-        for fname in filter(lambda f: f.find("receiver_callback") + 1, dir(self)):
-            self.mpvc.cbset.add(getattr(self, fname))
-
+        args = kw.get("args")
+        previous = kw.get("previous")
         if isinstance(self.needle, str):
             self.needle = self.needle, 0
         if self.needle and isinstance(self.needle[0], str):
             self.needle = re.compile(self.needle[0]), self.needle[1]
+        # keep an idle mpv around, so the first video doesn't wait for it
+        self.warm = getattr(args, "warm_mpv", False) and not self.feedmode
+        self.queue_mode = not getattr(args, "no_queue", False)
+        self.adaptive = getattr(args, "adaptive", False) and not self.feedmode
+        # the instance that replaced this one on a reload
+        self.successor = None
+        if previous is not None:
+            # the gauges keep counting the queues that get handed over
+            self.inherit(previous)
+            return
+        self.setup_mpv()
+        self.setup_resources(args)
+        self.add_callbacks()
+        STATS.gauge(
+            "mouselounge_cooldown_entries",
+            "Videos waiting for their cooldown to end",
+            self.cooldown.__len__,
+        )
+        STATS.gauge(
+            "mouselounge_play_queue_length",
+            "Videos waiting in the play queue",
+            self.playqueue.__len__,
+        )
+
+    def add_callbacks(self):
+        for fname in filter(lambda f: f.find("receiver_callback") + 1, dir(self)):
+            self.mpvc.cbset.add(getattr(self, fname))
+
+    def setup_mpv(self):
+        self.mpvc = MPV_IPC_Client()
+        # connects and sends to mpv that nobody awaits
+        self.tasks = set()
         self.mpvcfg = self.mpvc.create_tmp_filepath("mpvcfg")
         # kill mpv process after 30 mins of idling
-        self.mpvtimeout = None
+        self.mpvtimeout = (id(self), "mpv-idle")
         # making this config allows stopping the video without
         # killing the mpv process
         with open(self.mpvcfg, "w") as cfg:
             cfg.write("Q quit\n")
             cfg.write("q stop\n")
         self.mpv_started = False
+        self.mpv_played = False
+        # videos waiting for the current one to finish, when not in replace mode
+        self.playqueue = deque()
+        self.mpv_busy = False
+        self.mpv_idle = True
+        self.next_queued = False
+        # traces of the sent loadfiles, waiting for mpv to start playing them
+        self.loading = deque(maxlen=8)
+        if self.queue_mode:
+            for prop in "idle-active", "playlist-pos", "time-remaining":
+                self.mpvc.observe(prop)
+
+    def setup_resources(self, args):
+        # video id -> scheduler key of the timer that ends its cooldown
+        self.cooldown = {}
+        self.metadata = LRUCache(maxsize=128)
+        events = getattr(args, "events", None)
+        self.sink = EventSink(events) if events else None
+        # stdout belongs to the event sink if it writes there
+        self.terminal = Renderer(
+            sys.stderr if self.sink is not None and self.sink.is_stdout else None
+        )
+        path = getattr(args, "archive_path", None)
+        archive = path or getattr(args, "archive", False)
+        self.archive = Archive(path) if archive else None
+        self.quality = None
+        if self.adaptive:
+            self.quality = QualityController(
+                best=getattr(args, "max_quality", "720p"),
+                worst=getattr(args, "min_quality", "audio"),
+            )
+            for prop in (
+                "cache-speed",
+                "paused-for-cache",
+                "frame-drop-count",
+                "decoder-frame-drop-count",
+                "estimated-vf-fps",
+                "container-fps",
+            ):
+                self.mpvc.observe(prop)
+        self.streams = StreamResolver(self, self.format)
+        self.media = MediaCache(
+            self, self.cache_format, getattr(args, "cache_size", 0) * 2 ** 20
+        )
+
+    def inherit(self, previous):
+        """
+        Keeps mpv with its queue, the caches and the outputs of the instance
+        that a reload replaces, instead of starting them all over. Only reads
+        from `previous`, it keeps running until `take_over`
+        """
+        for name in (
+            "mpvc",
+            "tasks",
+            "mpvcfg",
+            "mpvtimeout",
+            "mpv_started",
+            "mpv_played",
+            "playqueue",
+            "mpv_busy",
+            "mpv_idle",
+            "next_queued",
+            "loading",
+            "sink",
+            "terminal",
+            "archive",
+            "quality",
+            "streams",
+            "media",
+            "cooldown",
+            "metadata",
+        ):
+            setattr(self, name, getattr(previous, name))
+
+    def take_over(self, previous):
+        """Moves the mpv events and the helpers over from `previous`"""
+        self.mpvc.cbset = {
+            cb
+            for cb in self.mpvc.cbset
+            if getattr(cb, "__self__", None) is not previous
+        }
+        self.add_callbacks()
+        self.streams.helper = self
+        self.media.helper = self
+        # on_start schedules it again for this instance
+        self.scheduler.cancel((id(previous), "quality"))
+        previous.successor = self
+
+    def echo(self, line, key=None):
+        """Lines with the same `key` get merged when they come in a burst"""
+        self.terminal.echo(line, key)
+
+    @property
+    def format(self):
+        if self.quality is not None:
+            return self.quality.format
+        return self.ytdl_format
+
+    def on_start(self):
+        if self.warm:
+            self.start_warm_mpv()
+        if self.adaptive:
+            self.scheduler.schedule(
+                self.quality_interval, self.sample_quality, key=(id(self), "quality")
+            )
+
+    def on_stop(self):
+        # mpv quits with the disconnect, it must not get respawned
+        self.warm = False
+        self.mpvc.disconnect()
+        self.terminal.close()
+
+    def sample_quality(self):
+        self.scheduler.schedule(
+            self.quality_interval, self.sample_quality, key=(id(self), "quality")
+        )
+        # an idle mpv has no stats to go by, the load isn't its doing either
+        if not self.mpvc.connected or not self.mpv_busy:
+            return
+        audio_only = self.quality.audio_only
+        level = self.quality.sample()
+        if level is None:
+            return
+        # already playing videos keep their format, except for dropping video
+        self.streams.fmt = level.format
+        self.send_data_to_mpv(
+            {"command": ["set_property", "ytdl-raw-options", f"format={level.format}"]}
+        )
+        if self.quality.audio_only != audio_only:
+            vid = "no" if self.quality.audio_only else "auto"
+            self.send_data_to_mpv({"command": ["set_property", "vid", vid]})
+
+    def quality_receiver_callback(self, response):
+        if self.adaptive and response.get("event") == "property-change":
+            self.quality.update(response.get("name"), response.get("data"))
 
     @staticmethod
-    def fixup(url):
-        return url
+    def fixup(video):
+        return video
 
     def handle_data(self, data):
         if not data:
             return True
         needle, group = self.needle
-        now = time()
-        if len(data) == 1:
-            url = data[0]
-            rest = []
-        else:
+        trace = getattr(data, "trace", None)
+        if len(data) > 1:
             # skip url verification if we are in the music room
-            url = f"https://www.youtube.com/watch?v={data[0]}"
-            rest = data[1:]
-            self.onurl(url, rest)
+            video = Video.from_id(data[0])
+            if not self.feedmode:
+                self.streams.resolve(video)
+            self.onurl(video, data[1:], trace)
             return True
-        for url in needle.finditer(url):
-            url = url.group(group).strip()
-            cd = self.cooldown.get(url, 0)
-            if cd + self.timeout > now:
-                print(
-                    f"{Fore.YELLOW}You can post {url} again "
-                    f"after {self.timeout-(now-cd):.2f} seconds.\n"
-                )
-                continue
-            self.cooldown[url] = now
+        rest = []
+        for url in needle.finditer(data[0]):
             try:
-                url = self.fixup(url)
-                if not url:
+                video = Video.from_url(url.group(group).strip())
+                if video is None:
+                    continue
+                if video.id in self.cooldown:
+                    COOLDOWN_HITS.inc()
+                    remaining = self.scheduler.remaining(self.cooldown[video.id])
+                    self.echo(
+                        f"{Fore.YELLOW}You can post {video.url} again "
+                        f"after {remaining:.2f} seconds.\n",
+                        key=("cooldown", video.id),
+                    )
                     continue
-                if self.onurl(url, rest) is False:
+                self.cooldown[video.id] = self.scheduler.schedule(
+                    self.timeout,
+                    self.cooldown.pop,
+                    video.id,
+                    None,
+                    key=(id(self), "cooldown", video.id),
+                )
+                video = self.fixup(video)
+                if not video:
+                    continue
+                if not self.feedmode:
+                    self.streams.resolve(video)
+                if self.onurl(video, rest, trace) is False:
                     break
             except Exception:
                 LOGGER.exception("failed to process")
         return True
 
     def process_callback(self, response):
+        if self.successor is not None:
+            # mpv was started before the managers got reloaded
+            return self.successor.process_callback(response)
         self.mpv_started = False
-        self.mpvc.disconnect()
+        self.mpv_busy = False
+        self.mpv_idle = True
+        self.next_queued = False
+        # the loop is gone if mpv quit because we are shutting down
+        with suppress(RuntimeError):
+            self.call_soon_threadsafe(self.mpvc.disconnect)
+            # the idle timer of this mpv would quit the next one early
+            self.call_soon_threadsafe(self.scheduler.cancel, self.mpvtimeout)
+            if self.warm and self.mpv_played:
+                self.call_soon_threadsafe(self.start_warm_mpv)
         retcode, stdout, stderr = response
         if retcode and int(retcode) != 4:
             LOGGER.error(
@@ -131,9 +347,27 @@ class WebManager(HelperManager):
             return False
         return True
 
-    def start_mpv(self):
+    def start_warm_mpv(self):
+        """
+        Warm instance doesn't have a window until it plays something and
+        gets quit by the idle timeout like any other, it's only respawned
+        after instances that were actually used.
+        """
+        if self.mpv_started:
+            return
+        LOGGER.debug("Starting warm mpv instance")
+        self.start_mpv(warm=True)
+        self.scheduler.schedule(
+            self.mpv_idle_timeout,
+            self.send_data_to_mpv,
+            {"command": ["quit"]},
+            key=self.mpvtimeout,
+        )
+
+    def start_mpv(self, warm=False):
         if self.mpv_started:
             return
+        self.mpv_played = False
         if os.access(self.mpvc.socket_file, os.F_OK):
             os.remove(self.mpvc.socket_file)
         self.run_process(
@@ -142,88 +376,233 @@ class WebManager(HelperManager):
             "--idle=yes",
             "--loop-playlist=no",
             "--loop-file=no",
+            "--prefetch-playlist=yes",
             "--cache-on-disk=yes",
             f"--cache-dir={self.mpvc.tmp_dir}",
             "--ontop",
             # "--autofit-larger=320x240",
             # "--autofit=320x240",
             "--geometry=480x280",
-            "--force-window=yes",
+            f"--force-window={'no' if warm else 'yes'}",
             # "--no-keepaspect",
             # "--no-keepaspect-window",
             # "--force-window-position",
             f"--input-conf={self.mpvcfg}",
             # "--no-video",
             f"--input-ipc-server={self.mpvc.socket_file}",
-            "--ytdl-raw-options=format="
-            "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/webm/mp4/best",
+            f"--ytdl-raw-options=format={self.format}",
         )
         self.mpv_started = True
-        self.connect_to_mpv()
-
-    def connect_to_mpv(self):
-        if not self.mpvc.is_socket_avaliable():
-            self.call_later(0.2, self.connect_to_mpv)
-            return
-        self.mpvc.connect()
+        self.spawn(self.mpvc.connect())
 
     def send_data_to_mpv(self, data):
-        if not self.mpvc.connected:
-            self.call_later(0.2, self.send_data_to_mpv, data)
-            return
-        self.mpvc.send_data(data)
+        self.spawn(self.mpvc.send_data(data))
 
-    def process_videos_with_mpv(self, url, duration_secs):
-        if self.mpvtimeout:
-            self.mpvtimeout.cancel()
+    def spawn(self, coro):
+        """The loop only keeps weak references to its tasks"""
+        task = self.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def process_videos_with_mpv(self, video, duration_secs, title=None, trace=None):
         self.start_mpv()
+        if self.queue_mode and self.mpv_busy:
+            self.playqueue.append((video, duration_secs, title, trace))
+            self.echo(
+                f"{Fore.YELLOW}Queued {video.url}, "
+                f"{len(self.playqueue)} in the queue.\n"
+            )
+            return
+        self.play(video, duration_secs, title, trace)
+
+    def play(self, video, duration_secs, title, trace=None, flags="replace", delay=0.0):
+        """`delay` is how long the video will wait in mpv's playlist"""
         timeout = (
             self.mpv_idle_timeout
             if duration_secs < self.mpv_idle_timeout
             else duration_secs + 30.0
         )
-        self.mpvtimeout = Timer(
-            timeout, lambda: self.send_data_to_mpv({"command": ["quit"]})
+        self.scheduler.schedule(
+            timeout + delay,
+            self.send_data_to_mpv,
+            {"command": ["quit"]},
+            key=self.mpvtimeout,
         )
-        self.mpvtimeout.setDaemon(True)
-        self.mpvtimeout.start()
-        self.send_data_to_mpv({"command": ["loadfile", url]})
+        if self.warm and not self.mpv_played:
+            self.send_data_to_mpv({"command": ["set_property", "force-window", "yes"]})
+        self.mpv_played = True
+        self.mpv_busy = True
+        self.send_when_resolved(video, title, flags, trace)
+
+    def queue_receiver_callback(self, response):
+        if response.get("event") != "property-change":
+            return
+        name, data = response.get("name"), response.get("data")
+        if name == "idle-active":
+            if bool(data) == self.mpv_idle:
+                # mpv reports the idle state it starts in on every connection
+                return
+            self.mpv_idle = bool(data)
+            if not data and self.next_queued:
+                # the appended entry started from idle, at the front of the
+                # playlist if the playlist-clear came after the end of it
+                self.next_queued = False
+            # an appended entry that is still being resolved starts by itself
+            self.mpv_busy = not data or self.next_queued
+            if data and self.playqueue and not self.next_queued:
+                self.play(*self.playqueue.popleft())
+        elif name == "time-remaining":
+            if data is None or data > self.preload_ahead:
+                return
+            if self.playqueue and not self.next_queued:
+                # mpv starts prefetching the next playlist entry right away, and
+                # plays it even if the current one ends before it got resolved
+                self.next_queued = True
+                self.play(*self.playqueue.popleft(), flags="append-play", delay=data)
+        elif name == "playlist-pos":
+            if self.next_queued and data and data > 0:
+                self.next_queued = False
+                # drop the finished entries, so the playlist doesn't grow
+                self.send_data_to_mpv({"command": ["playlist-clear"]})
+
+    def send_when_resolved(self, video, title, flags="replace", trace=None):
+        path = self.media.get(video)
+        self.media.played(video)
+        if path:
+            LOGGER.debug("Playing %s from the media cache", video.id)
+            self.send_loadfile(self.play_command(video, title, flags, path=path), trace)
+            return
+        key = (id(self), "resolve", video.id)
 
-    def onurl(self, url, rest):
+        def send(stream):
+            # timer is gone if we already gave up on waiting for the stream
+            if self.scheduler.cancel(key):
+                self.send_loadfile(
+                    self.play_command(video, title, flags, stream), trace
+                )
+
+        self.scheduler.schedule(
+            self.resolve_timeout,
+            lambda: self.send_loadfile(self.play_command(video, title, flags), trace),
+            key=key,
+        )
+        self.streams.resolve(video, send)
+
+    def send_loadfile(self, command, trace=None):
+        if command["command"]["flags"] == "replace":
+            self.loading.clear()
+        if trace is not None:
+            self.loading.append(trace.stamp("loadfile"))
+        self.send_data_to_mpv(command)
+
+    def trace_receiver_callback(self, response):
+        etype = response.get("event")
+        if not self.loading or etype not in ("file-loaded", "playback-restart"):
+            return
+        trace = self.loading[0]
+        if etype == "file-loaded":
+            trace.stamp(etype)
+        elif "file-loaded" in trace.stamps:
+            self.loading.popleft()
+            TRACER.finish(trace.stamp(etype))
+
+    def play_command(self, video, title, flags="replace", stream=None, path=None):
+        if stream is None and path is None:
+            LOGGER.debug("No stream for %s, leaving it to ytdl hook", video.id)
+            return self.loadfile_command(video.url, video.start, flags)
+        options = {"ytdl": "no"}
+        if title:
+            options["force-media-title"] = title
+        if path is not None:
+            return self.loadfile_command(path, video.start, flags, **options)
+        if len(stream.urls) > 1:
+            options["audio-file"] = stream.urls[1]
+        return self.loadfile_command(stream.urls[0], video.start, flags, **options)
+
+    @staticmethod
+    def loadfile_command(url, start=0.0, flags="replace", **options):
+        if start:
+            options["start"] = f"{start:.3f}"
+        return {
+            "command": {
+                "name": "loadfile",
+                "url": url,
+                "flags": flags,
+                "options": options,
+            }
+        }
+
+    def get_metadata(self, video):
+        """
+        Returns (title, duration_secs, description) of the video, the results
+        are cached under the video id.
+        """
+        with suppress(KeyError):
+            metadata = self.metadata[video.id]
+            METADATA_HITS.inc()
+            return metadata
+        METADATA_MISSES.inc()
         title, duration, desc = self.extract(
-            url, self.title, self.duration, self.description
+            video.url, self.title, self.duration, self.description
         )
         if title is None:
-            return True
+            return None
         title = self.unescape(title.group(1))
         if not title:
-            return True
-        desc = self.unescape(desc.group(1))
+            return None
+        desc = self.unescape(desc.group(1)) if desc else ""
         duration_secs = 0.0
         if duration:
-            duration_secs = isodate.parse_duration(duration.group(1))
-            duration = str(duration_secs)
-            duration_secs = duration_secs.total_seconds()
+            duration_secs = isodate.parse_duration(duration.group(1)).total_seconds()
+        self.metadata[video.id] = title, duration_secs, desc
+        return self.metadata[video.id]
+
+    def onurl(self, video, rest, trace=None):
+        metadata = self.get_metadata(video)
+        if metadata is None:
+            return True
+        if trace is not None:
+            trace.stamp("metadata")
+        title, duration_secs, desc = metadata
+        duration = str(timedelta(seconds=duration_secs)) if duration_secs else ""
         if not self.feedmode:
-            self.process_videos_with_mpv(url, duration_secs)
-        print(
+            self.process_videos_with_mpv(video, duration_secs, title, trace)
+        else:
+            TRACER.finish(trace)
+        event = {
+            "ts": time(),
+            "room": "musicroom" if rest else "tribehouse",
+            "video_id": video.id,
+            "start": video.start,
+            "title": title,
+            "duration": duration_secs,
+            "poster": rest[1] if len(rest) > 1 else None,
+        }
+        if self.archive is not None:
+            self.archive.record(event)
+        self.publish("video", event)
+        if self.sink is not None:
+            self.sink.emit(event)
+            if self.sink.is_stdout:
+                return True
+        self.echo(
             strftime(
                 f"{Fore.LIGHTBLUE_EX}Post time: {Fore.RESET}%a, %d %b %Y, %H:%M:%S",
                 localtime(),
             )
         )
         if len(rest) > 1:
-            print(f"{Fore.CYAN}Poster: {Fore.RESET}{rest[1]}")
+            self.echo(f"{Fore.CYAN}Poster: {Fore.RESET}{rest[1]}")
         yt = f"{Fore.RED}Youtube: {Fore.RESET}"
-        print(f"{Fore.MAGENTA}Link: {Fore.RESET}{url}")
+        self.echo(f"{Fore.MAGENTA}Link: {Fore.RESET}{video.url}")
         if duration and desc:
-            print(f"{yt}{title} ({duration})\n{desc}\n")
+            self.echo(f"{yt}{title} ({duration})\n{desc}\n")
         elif duration:
-            print(f"{yt}{title} ({duration})\n")
+            self.echo(f"{yt}{title} ({duration})\n")
         elif desc:
-            print(f"{yt}{title}\n{desc}\n")
+            self.echo(f"{yt}{title}\n{desc}\n")
         else:
-            print(f"{yt}{title}\n")
+            self.echo(f"{yt}{title}\n")
         return True
 
     @staticmethod
@@ -257,9 +636,16 @@ class XYoutuberCommunityManager(WebManager, CommunityManager):
 
     last_event = None
 
+    def inherit(self, previous):
+        super().inherit(previous)
+        self.last_event = previous.last_event
+
     def receiver_callback(self, response):
         LOGGER.debug("from community: %s", response)
         etype = response.get("event")
         if self.last_event == "end-file" and etype == "start-file":
-            print(f"{Fore.YELLOW}We got a skipper!\n")
+            self.echo(f"{Fore.YELLOW}We got a skipper!\n")
+        # queued videos end with eof, only replaced ones get stopped
+        if etype == "end-file" and response.get("reason") != "stop":
+            etype = None
         self.last_event = etype
@@ -0,0 +1,178 @@
+"""
+Local cache of downloaded videos, so the songs that get played over and over
+again don't have to be streamed every time.
+"""
+import logging
+import os
+
+from collections import OrderedDict, deque
+from contextlib import suppress
+from functools import partial
+from hashlib import sha1
+
+from cachetools import LRUCache
+
+from .utils import u8str
+from .stats import STATS
+
+__all__ = ["MediaCache"]
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_HITS = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="media", result="hit"
+)
+CACHE_MISSES = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="media", result="miss"
+)
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "mouselounge", "media")
+
+
+class MediaCache:
+    """
+    Files are named after the hash of the video id and the format, so the
+    same video downloaded with a different format is a different entry.
+    `index` keeps the entries in LRU order, oldest first, and gets rebuilt
+    from modification times on startup.
+    """
+
+    # download the video only after it was played that many times
+    min_plays = 2
+    max_downloads = 2
+
+    def __init__(self, helper, fmt, budget, directory=None):
+        self.helper = helper
+        self.fmt = fmt
+        self.budget = budget
+        self.directory = directory or default_cache_dir()
+        self.index = OrderedDict()
+        self.size = 0
+        self.plays = LRUCache(maxsize=1024)
+        self.queue = deque()
+        self.downloading = set()
+        if self.budget > 0:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_index()
+        STATS.gauge(
+            "mouselounge_media_cache_bytes",
+            "Size of the media cache",
+            lambda: self.size,
+        )
+
+    def __bool__(self):
+        return self.budget > 0
+
+    def key(self, video, fmt=None):
+        fmt = fmt or self.fmt
+        return sha1(f"{video.id}\0{fmt}".encode("utf8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".part"):
+                    # leftovers from a download that never finished
+                    with suppress(OSError):
+                        os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _mtime, name, size in sorted(entries):
+            self.index[name] = size
+            self.size += size
+        self.evict()
+        LOGGER.debug(
+            "Media cache has %d entries, %.1f MiB", len(self.index), self.size / 2 ** 20
+        )
+
+    def get(self, video, fmt=None):
+        """Returns the path of the cached file or None, marks hits as used"""
+        if not self:
+            return None
+        key = self.key(video, fmt)
+        if key not in self.index:
+            CACHE_MISSES.inc()
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            CACHE_MISSES.inc()
+            self.size -= self.index.pop(key)
+            return None
+        CACHE_HITS.inc()
+        self.index.move_to_end(key)
+        return path
+
+    def played(self, video, fmt=None):
+        """Counts plays and queues a download once the video gets popular"""
+        if not self:
+            return
+        plays = self.plays.get(video.id, 0) + 1
+        self.plays[video.id] = plays
+        key = self.key(video, fmt)
+        if plays < self.min_plays or key in self.index or key in self.downloading:
+            return
+        if any(k == key for k, _v, _f in self.queue):
+            return
+        self.queue.append((key, video, fmt or self.fmt))
+        self._download_next()
+
+    def _download_next(self):
+        while self.queue and len(self.downloading) < self.max_downloads:
+            key, video, fmt = self.queue.popleft()
+            self.downloading.add(key)
+            # youtube-dl treats % in the output as a template
+            output = f"{self.path(key)}.part".replace("%", "%%")
+            LOGGER.debug("Downloading %s into the media cache", video.id)
+            self.helper.run_process(
+                partial(self._process_callback, key),
+                "youtube-dl",
+                "--no-playlist",
+                "--no-part",
+                "--quiet",
+                "-f",
+                fmt,
+                "-o",
+                output,
+                video.url,
+            )
+
+    def _process_callback(self, key, response):
+        self.helper.call_soon_threadsafe(self._downloaded, key, response)
+
+    def _downloaded(self, key, response):
+        retcode, _stdout, stderr = response
+        self.downloading.discard(key)
+        part = f"{self.path(key)}.part"
+        try:
+            if retcode:
+                raise OSError(u8str(stderr).strip())
+            size = os.stat(part).st_size
+            os.replace(part, self.path(key))
+        except OSError as ex:
+            LOGGER.warning("Media cache download of %s failed: %s", key, ex)
+            with suppress(OSError):
+                os.remove(part)
+        else:
+            self.index[key] = size
+            self.size += size
+            self.evict()
+        self._download_next()
+
+    def evict(self):
+        while self.index and self.size > self.budget:
+            key, entry_size = self.index.popitem(last=False)
+            self.size -= entry_size
+            with suppress(FileNotFoundError):
+                os.remove(self.path(key))
+            LOGGER.debug("Evicted %s from the media cache", key)
@@ -1,101 +1,127 @@
 import logging
 import asyncio
+import os
 import sys
 import inspect
 import signal
 
 
-from os import devnull
-from shutil import which
 from contextlib import suppress
+from itertools import chain
 from re import search
+from time import monotonic
 
+from .capture import PacketFetcherError, fetcher_command
 from .listeners import Listeners
+from .looplag import LAG, new_event_loop
 from .protocol import PROTO, ProtocolHandler
+from .scheduler import Scheduler
+from .sources import SourceSet
+from .tracing import Trace, Traced
+from .stats import STATS, serve
 
 LOGGER = logging.getLogger(__name__)
 
-
-class PacketFetcherError(Exception):
-    def __init__(self, msg=""):
-        super().__init__()
-        self.msg = msg
-
-    def __str__(self):
-        if self.msg:
-            return str(self.msg).strip()
-        return PacketFetcherError.__name__
-
-
-class PacketFetcherProtocol(asyncio.SubprocessProtocol):
-    def __init__(self, loop):
-        self.stopped = False
-        self.error_data = str()
-        self._loop = loop
-        self._future = self._loop.create_future()
-
-    def pipe_data_received(self, fd, data):
-        if fd == 1:
-            self._future.set_result(data)
-            self._future = self._loop.create_future()
-        elif fd == 2:
-            for e in data.decode("utf8").splitlines():
-                self.error_data += f"{e}\n"
-            # tcpflow prints status stuff into stderr so we have to ignore it
-            for status in "listening", "reportfilename":
-                if status in self.error_data.lower() or len(self.error_data) <= 2:
-                    self.error_data = str()
-                    break
-
-    async def yielder(self):
-        """
-        Yielding async generator that returns bytes objects.
-        This function is operable only when tcpdump is run with
-        "-Uw-" arguments or when tcpflow is run with "-0BC" arguments.
-        """
-        while not self.stopped:
-            try:
-                data = await self._future
-                for packet in data.split(b"\n"):
-                    if len(packet) > 7:
-                        yield packet
-            except asyncio.CancelledError:
-                break
-
-    def pipe_connection_lost(self, _fd, _exc):
-        self.stopped = True
-        self._future.cancel()
-
-    def process_exited(self):
-        LOGGER.debug("PacketFetcher game instance exited.")
-        self.stopped = True
-        self._future.cancel()
+SHUTDOWN_SECONDS = STATS.gauge(
+    "mouselounge_shutdown_seconds", "How long the last shutdown took"
+)
+
+
+def _coro_name(task):
+    return search(r"coro=<\s*(.+?)\s*>", str(task)).group(1)
+
+
+def _use_pidfd_watcher():
+    """
+    Children get reaped by the loop through pidfds, instead of a thread
+    per child blocking in waitpid. Python 3.12 does this on its own.
+    """
+    if sys.version_info >= (3, 12) or not hasattr(os, "pidfd_open"):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        # kernel is older than 5.3
+        return
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+
+
+async def _finish(loop, tasks, transports, timeout):
+    deadline = loop.time() + timeout
+    if tasks:
+        _done, stuck = await asyncio.wait(tasks, timeout=timeout)
+        for task in stuck:
+            LOGGER.warning("%s didn't stop in time", _coro_name(task))
+    # the child watcher needs the loop to see the fetchers exit
+    for transport in transports:
+        while transport.get_returncode() is None and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        transport.close()
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(
+            loop.shutdown_asyncgens(), max(deadline - loop.time(), 0)
+        )
 
 
 class Mousapi:
 
     tasklist = []
+    # everything gets cancelled at once and has this long to finish
+    shutdown_budget = 2.0
 
     def __init__(self, args):
         if sys.platform != "win32":
-            self.loop = asyncio.new_event_loop()
+            self.loop = new_event_loop(getattr(args, "uvloop", False))
+            # uvloop watches its children on its own
+            if isinstance(self.loop, asyncio.SelectorEventLoop):
+                _use_pidfd_watcher()
         else:
             self.loop = asyncio.ProactorEventLoop()
         asyncio.set_event_loop(self.loop)
 
-        self.game_transport = None
-        self.game_protocol = None
+        self.fetcher = getattr(args, "fetcher", None)
+        self.sources = SourceSet.from_specs(
+            self.loop,
+            getattr(args, "source", None),
+            getattr(args, "capture_process", False),
+            self.fetcher,
+        )
         self.retcodes = None
         self.pending = None
         self.interrupted = False
-
-        self.fetcher_args = [
-            "tcp and net 94.23.193.0/24 or net 51.75.130.0/24 or net 37.187.29.0/24 and inbound"
-        ]
+        self.closers = []
 
         self.event = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.scheduler = Scheduler(self.loop)
         self.listener = Listeners()
         self.protohandler = ProtocolHandler()
+        self.stats_address = getattr(args, "stats", None)
+        self.stats_server = None
+        # ControlServer of the daemon mode, set up together with the managers
+        self.control = None
+        self.matches = {
+            key: STATS.counter(
+                "mouselounge_proto_matches_total",
+                "Lines matching the known protocol values",
+                opcode=key.hex(),
+                event=PROTO[key],
+            )
+            for key in self.protohandler.keys()
+        }
+        STATS.gauge(
+            "mouselounge_listener_queue_depth",
+            "Items waiting in the listener queue",
+            lambda: sum(len(v) for v in self.listener.queue.values()),
+        )
+        STATS.gauge(
+            "mouselounge_listeners", "Registered listener types", self.listener.__len__
+        )
+        STATS.gauge(
+            "mouselounge_scheduler_timers",
+            "Timers pending in the scheduler",
+            self.scheduler.__len__,
+        )
 
         def handler(signal):
             self.global_stop = True
@@ -104,50 +130,65 @@ class Mousapi:
 
         self.loop.add_signal_handler(signal.SIGQUIT, handler, "SIGQUIT")
         self.loop.add_signal_handler(signal.SIGINT, handler, "SIGINT")
+        lag_threshold = getattr(args, "lag_threshold", None)
+        LAG.start(self.loop, None if lag_threshold is None else lag_threshold / 1000)
 
     def add_listener(self, event, data):
         self.listener.add(event, data)
 
+    def add_closer(self, callback):
+        """`callback` runs first thing on shutdown, while the loop is still usable"""
+        self.closers.append(callback)
+
     async def _init_protocol_and_transport(self):
-        args = []
-        if which("tcpdump"):
-            args.append("tcpdump")
-            args.append("-Uw-")
-        elif which("tcpflow"):
-            args.append("tcpflow")
-            args.append("-0CB")
-            args.append(f"-X{devnull}")
-        else:
+        try:
+            fetcher_command(self.fetcher)
+        except RuntimeError:
             self.event.set()
             asyncio.ensure_future(self.loop.shutdown_asyncgens())
-            raise RuntimeError(
-                "You don't have a program that can fetch packets!\n"
-                "Install tcpdump or tcpflow and try again!"
-            )
-
-        transport, protocol = await self.loop.subprocess_exec(
-            lambda : PacketFetcherProtocol(self.loop),
-            *args + self.fetcher_args,
-            stdout=asyncio.subprocess.PIPE,
-            stdin=None,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        self.game_transport = transport
-        self.game_protocol = protocol
+            raise
         self.event.set()
 
+    def dispatch(self, key, data, ts, decode_ts=None):
+        """Hands decoded data of the protocol value `key` to the listeners"""
+        self.matches[key].inc()
+        if data:
+            data = Traced(data, Trace(ts).stamp("decode", decode_ts))
+        self.listener.enqueue(PROTO[key], data)
+        self.listener.process()
+
     async def _handle_game_server_data(self):
         await self.event.wait()
-        async for line in self.game_protocol.yielder():
-            for key in self.protohandler.keys():
-                if match := search(key, line):
-                    LOGGER.debug("Matched game line for key %s: %s", key, line)
-                    self.listener.enqueue(
-                        PROTO[key], self.protohandler(key, line, match)
-                    )
-                    self.listener.process()
-        if self.game_protocol.error_data:
-            raise PacketFetcherError(self.game_protocol.error_data)
+        try:
+            async for key, data, ts, decode_ts in self.sources.events():
+                self.dispatch(key, data, ts, decode_ts)
+        finally:
+            self.finished.set()
+        error_data = self.sources.error_data
+        if error_data:
+            raise PacketFetcherError(error_data)
+
+    def _bind_stats(self):
+        """A bad address fails the startup, instead of the stats quietly missing"""
+        try:
+            self.stats_server = self.loop.run_until_complete(serve(self.stats_address))
+        except (OSError, ValueError) as ex:
+            raise RuntimeError(
+                f"Can't serve stats on {self.stats_address}: {ex}"
+            ) from ex
+        LOGGER.info("Serving stats on %s", self.stats_address)
+
+    async def _serve_stats(self):
+        if self.stats_server is None:
+            return
+        async with self.stats_server:
+            # stats die together with the capture
+            await self.finished.wait()
+
+    async def _serve_control(self):
+        if self.control is None:
+            return
+        await self.control.serve(self.finished)
 
     def __enter__(self):
         return self
@@ -160,13 +201,12 @@ class Mousapi:
 
     @property
     def global_stop(self):
-        with suppress(AttributeError):
-            return self.game_protocol.stopped
+        return self.sources.stopped
 
     @global_stop.setter
     def global_stop(self, value):
-        with suppress(AttributeError):
-            self.game_protocol.stopped = value
+        if value:
+            self.sources.stop()
 
     def _append_tasks(self):
         fnames_fobjs = inspect.getmembers(self, predicate=inspect.iscoroutinefunction)
@@ -178,39 +218,57 @@ class Mousapi:
         if not len(self.listener):
             raise RuntimeError("I got nothing to listen to!")
 
+        if self.stats_address:
+            self._bind_stats()
         self._append_tasks()
 
         LOGGER.debug("Current coroutines: %s", self.tasklist)
         self.retcodes, self.pending = self.loop.run_until_complete(
-            asyncio.wait([fobj() for _fname, fobj in Mousapi.tasklist])
+            asyncio.wait(
+                [self.loop.create_task(fobj()) for _fname, fobj in Mousapi.tasklist]
+            )
         )
 
     def gracefull_close(self):
-        """Close all pending tasks and exit"""
-
-        def print_coro(coro):
-            return search(r"coro=<\s*(.+?)\s*>", str(coro)).group(1)
-
+        """
+        Cancels all of the tasks at once and gives them `shutdown_budget`
+        seconds in total to finish, whatever is left after that is abandoned.
+        """
+        started = monotonic()
         self.global_stop = True
+        for closer in self.closers:
+            try:
+                closer()
+            except Exception:
+                LOGGER.exception("Failed to run %r on shutdown", closer)
+        self.scheduler.close()
+        LAG.stop()
 
-        with suppress(ProcessLookupError, AttributeError):
-            self.game_transport.terminate()
+        self.sources.close(timeout=self.shutdown_budget / 2)
 
-        errors = []
-        for task in self.pending:
+        tasks = [task for task in asyncio.all_tasks(self.loop) if not task.done()]
+        for task in tasks:
             task.cancel()
-            # Now we should await task to execute it's cancellation.
-            # Cancelled task raises asyncio.CancelledError that we can suppress:
-            with suppress(asyncio.CancelledError):
-                try:
-                    self.loop.run_until_complete(task)
-                except PacketFetcherError:
-                    if not self.interrupted:
-                        errors.append((print_coro(task), task.exception()))
+        remaining = max(self.shutdown_budget - (monotonic() - started), 0)
+        self.loop.run_until_complete(
+            _finish(self.loop, tasks, self.sources.transports, remaining)
+        )
+
+        errors = []
+        for task in chain(self.retcodes or (), self.pending or ()):
+            if not task.done() or task.cancelled():
+                continue
+            ex = task.exception()
+            if ex is None:
+                continue
+            if not isinstance(ex, PacketFetcherError):
+                LOGGER.error("%s failed", _coro_name(task), exc_info=ex)
+            elif not self.interrupted:
+                errors.append((_coro_name(task), ex))
         self.loop.close()
-        if self.retcodes is not None:
-            for coro, ex in errors:
-                LOGGER.error("\n%s returned: %s", coro, ex)
+        SHUTDOWN_SECONDS.set(monotonic() - started)
+        for coro, ex in errors:
+            LOGGER.error("\n%s returned: %s", coro, ex)
 
         LOGGER.info("See ya around")
         if self.interrupted:
@@ -24,13 +24,21 @@ THE SOFTWARE.
 
 import logging
 import signal
+import threading
 import multiprocessing as mp
 import subprocess
 
+from .stats import STATS
+
 LOGGER = logging.getLogger(__name__)
 
+# set in the workers, tells them to stop whatever they started
+_STOPPING = None
+
 
-def _init_worker():
+def _init_worker(stopping):
+    global _STOPPING  # pylint: disable=global-statement
+    _STOPPING = stopping
     try:
         # workaround for fucken pool workers being retarded
         signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -38,11 +46,14 @@ def _init_worker():
     except Exception:
         pass  # wangblows might not like it
 
+    # forked workers inherit the queue handler of the parent, but not the
+    # thread that writes the queue out, their records would just pile up
     logging.basicConfig(
         level=logging.ERROR,
         format="%(asctime)s.%(msecs)03d %(threadName)s %(levelname)s "
         "%(module)s: %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
+        force=True,
     )
     logging.getLogger("requests").setLevel(logging.WARNING)
     # LOGGER.info("starting processor")
@@ -61,6 +72,17 @@ def _run_process(*args, **kwds):
                     event.clear()
                 return proc.returncode, stdout, stderr
             except subprocess.TimeoutExpired:
+                if _STOPPING.is_set():
+                    # terminating the pool would leave it behind
+                    proc.terminate()
+                    try:
+                        stdout, stderr = proc.communicate(
+                            timeout=Processor.stop_timeout
+                        )
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                        stdout, stderr = proc.communicate()
+                    return proc.returncode, stdout, stderr
                 if event and event.is_set():
                     event.clear()
                     proc.terminate()
@@ -79,20 +101,65 @@ def _run_process(*args, **kwds):
 
 
 class Processor:
+    # how long close waits for the workers to stop their children
+    stop_timeout = 0.5
+
     def __init__(self):
-        self.pool = mp.Pool(5, initializer=_init_worker, maxtasksperchild=5)
+        self.stopping = mp.Event()
+        self.pool = mp.Pool(
+            5, initializer=_init_worker, initargs=(self.stopping,), maxtasksperchild=5
+        )
+        # the results come in on a thread of the pool
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        STATS.gauge(
+            "mouselounge_processor_pending",
+            "Child processes running or waiting for a free worker of the pool",
+            lambda: self.pending,
+        )
+        self.started = STATS.counter(
+            "mouselounge_processor_started_total", "Child processes started"
+        )
 
     def __call__(self, callback, *args, **kwargs):
         LOGGER.debug("running %r, %r", args, kwargs)
+
+        def done(result):
+            self.finished()
+            # the children got stopped, not done
+            if not self.stopping.is_set():
+                callback(result)
+
         try:
+            with self.lock:
+                self.pending += 1
+            self.started.inc()
             self.pool.apply_async(
-                _run_process, args, kwargs, callback, error_callback=self.error
+                _run_process, args, kwargs, done, error_callback=self.error
             )
         except Exception:
+            self.finished()
             LOGGER.exception("failed to run processor")
 
-    @staticmethod
-    def error(*args, **kw):
+    def close(self):
+        """
+        Stops whatever is still running, nobody waits for the results anymore.
+        The workers stop the processes they started, terminating the pool
+        would leave those behind.
+        """
+        self.stopping.set()
+        with self.idle:
+            self.idle.wait_for(lambda: not self.pending, 2 * self.stop_timeout)
+        self.pool.terminate()
+
+    def finished(self):
+        with self.lock:
+            self.pending -= 1
+            self.idle.notify_all()
+
+    def error(self, *args, **kw):
+        self.finished()
         LOGGER.error("failed to run processor %r %r", args, kw)
 
 
@@ -0,0 +1,139 @@
+"""
+Profiling that can be turned on and off while the thing is running
+"""
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+
+from collections import Counter
+from tempfile import gettempdir
+from time import sleep, strftime
+
+__all__ = ["SamplingProfiler", "MemorySnapshots", "PROFILER", "SNAPSHOTS"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+def output_dir():
+    return os.environ.get("XDG_RUNTIME_DIR") or gettempdir()
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of all the threads every `interval` seconds from
+    a separate thread. Stopping it writes the samples in the collapsed
+    stack format that flamegraph.pl and speedscope understand.
+    """
+
+    interval = 0.005
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def toggle(self):
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self._running.set()
+        self._thread = threading.Thread(
+            daemon=True, target=self._sampler, name="SamplingProfiler"
+        )
+        self._thread.start()
+        LOGGER.info("Sampling profiler started")
+
+    def stop(self):
+        if not self.running:
+            return None
+        self._running.clear()
+        self._thread.join()
+        name = f"mouselounge-{os.getpid()}-{strftime('%Y%m%d-%H%M%S')}.folded"
+        path = os.path.join(output_dir(), name)
+        self.write(path)
+        LOGGER.info("Profiler wrote %d samples to %s", self.samples, path)
+        return path
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+    def _sampler(self):
+        own = threading.get_ident()
+        while self._running.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            # pylint: disable=protected-access
+            for ident, frame in sys._current_frames().items():
+                # pylint: enable=protected-access
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            sleep(self.interval)
+
+    def write(self, path):
+        with open(path, "w") as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+
+class MemorySnapshots:
+    """
+    First call starts tracemalloc, every next one compares a new
+    snapshot against the previous one and reports the biggest growth.
+    """
+
+    frames = 10
+    limit = 15
+
+    def __init__(self):
+        self.previous = None
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.previous = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        previous, self.previous = self.previous, snapshot
+        if previous is None:
+            return "Started tracing allocations, next snapshot will show the growth"
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"Traced memory {current / 2 ** 20:.1f} MiB, "
+            f"peak {peak / 2 ** 20:.1f} MiB, "
+            f"top {self.limit} changes since the previous snapshot:"
+        ]
+        for stat in snapshot.compare_to(previous, "lineno")[: self.limit]:
+            lines.append(f"  {stat}")
+        return "\n".join(lines)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+
+PROFILER = SamplingProfiler()
+SNAPSHOTS = MemorySnapshots()
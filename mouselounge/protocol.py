@@ -3,9 +3,14 @@ Known mouse protocol values goes here
 """
 import logging
 
+from contextlib import suppress
+from re import search
 from struct import unpack
 from struct import error as StructError
 
+from .logs import Payload
+from .stats import STATS
+
 LOGGER = logging.getLogger(__name__)
 
 PROTO = {
@@ -16,6 +21,16 @@ PROTO = {
 }
 
 
+DECODE_FAILURES = {
+    name: STATS.counter(
+        "mouselounge_decode_failures_total",
+        "Matched lines that failed to decode",
+        event=name,
+    )
+    for name in PROTO.values()
+}
+
+
 class ProtocolHandler(dict):
     """
     Extract data from incoming packets. PROTO defines
@@ -34,6 +49,13 @@ class ProtocolHandler(dict):
     def __call__(self, event, line, match):
         return self[event](line, match)
 
+    def decode(self, line):
+        """Yields (key, data) for every known value found in the line"""
+        for key in self.keys():
+            if match := search(key, line):
+                LOGGER.debug("Matched game line for key %s: %s", key, Payload(line))
+                yield key, self(key, line, match)
+
     @staticmethod
     def play_vid_tribehouse(line, match):
         try:
@@ -43,7 +65,8 @@ class ProtocolHandler(dict):
             # 43 is lenght of youtube.com link, sometimes script seems to pull some gibberish?
             link = line[n:(n+43)].decode("ascii")
         except (IndexError, UnicodeDecodeError) as ex:
-            LOGGER.debug("%s line failed with:\n%s", line, ex)
+            DECODE_FAILURES["play_vid_tribehouse"].inc()
+            LOGGER.debug("%s line failed with:\n%s", Payload(line), ex)
             return ()
         return (link,)
 
@@ -74,10 +97,12 @@ class ProtocolHandler(dict):
             LOGGER.debug("Data in musicroom: \n%s \n%s \n%s", link, video_name, nick)
             return link, video_name, nick
         except UnicodeDecodeError as ex:
+            with suppress(KeyError):
+                DECODE_FAILURES["play_vid_musicroom"].inc()
             if "'ascii'" in str(ex):
-                LOGGER.debug("%s line failed with:\n%s", line, ex)
+                LOGGER.debug("%s line failed with:\n%s", Payload(line), ex)
                 return ()
-            LOGGER.exception("%s line failed with:\n%s", line, ex)
+            LOGGER.exception("%s line failed with:\n%s", Payload(line), ex)
             return ()
 
     def __repr__(self):
@@ -0,0 +1,170 @@
+"""
+Picking the playback format depending on how busy the machine is
+and how fast the videos are downloading.
+"""
+import logging
+import os
+
+from collections import namedtuple
+
+__all__ = ["Level", "LEVELS", "QualityController", "CpuSampler"]
+
+LOGGER = logging.getLogger(__name__)
+
+# bitrate is a rough estimate of what the format needs in bytes/s
+Level = namedtuple("Level", ("name", "format", "bitrate"))
+
+LEVELS = (
+    Level(
+        "1080p",
+        "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]",
+        5_000_000 // 8,
+    ),
+    Level(
+        "720p",
+        "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/webm/mp4/best",
+        2_500_000 // 8,
+    ),
+    Level(
+        "480p",
+        "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480]/best",
+        1_200_000 // 8,
+    ),
+    Level(
+        "360p",
+        "bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]/best",
+        700_000 // 8,
+    ),
+    Level("audio", "bestaudio[ext=m4a]/bestaudio/best", 160_000 // 8),
+)
+
+LEVEL_NAMES = [l.name for l in LEVELS]
+
+
+class CpuSampler:
+    """System wide cpu usage between two calls, from /proc/stat"""
+
+    def __init__(self):
+        self.last = self._read()
+
+    @staticmethod
+    def _read():
+        try:
+            with open("/proc/stat") as stat:
+                fields = [int(f) for f in stat.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        # idle + iowait
+        return sum(fields), fields[3] + fields[4]
+
+    def __call__(self):
+        current = self._read()
+        if current is None or self.last is None:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        total, idle = current[0] - self.last[0], current[1] - self.last[1]
+        self.last = current
+        if total <= 0:
+            return 0.0
+        return 1.0 - idle / total
+
+
+class QualityController:
+    """
+    Steps down a level right away when the cpu is saturated, frames
+    get dropped or mpv had to pause for cache. Steps up only after
+    `stable_samples` good samples in a row and when the measured download
+    speed is enough for the next level. Levels stay between `best` and `worst`.
+    """
+
+    cpu_high = 0.85
+    cpu_low = 0.5
+    max_drops = 5
+    stable_samples = 3
+
+    def __init__(self, best="720p", worst="audio", start="720p"):
+        self.best = LEVEL_NAMES.index(best)
+        self.worst = LEVEL_NAMES.index(worst)
+        if self.best > self.worst:
+            raise ValueError("Best quality can't be worse than the worst one")
+        self.current = min(max(LEVEL_NAMES.index(start), self.best), self.worst)
+        self.cpu = CpuSampler()
+        self.props = {}
+        self.good = 0
+        self.last_drops = 0
+        self.max_speed = 0.0
+        self.stalled = False
+
+    @property
+    def level(self):
+        return LEVELS[self.current]
+
+    @property
+    def format(self):
+        return self.level.format
+
+    @property
+    def audio_only(self):
+        return self.level.name == "audio"
+
+    def update(self, name, data):
+        """Feed mpv property changes here"""
+        if data is None:
+            return
+        self.props[name] = data
+        if name == "cache-speed":
+            self.max_speed = max(self.max_speed, data)
+        elif name == "paused-for-cache" and data:
+            self.stalled = True
+
+    def _frame_problems(self):
+        drops = self.props.get("frame-drop-count", 0) + self.props.get(
+            "decoder-frame-drop-count", 0
+        )
+        # counters start over with every file
+        new_drops = drops - self.last_drops if drops >= self.last_drops else drops
+        self.last_drops = drops
+        fps = self.props.get("estimated-vf-fps")
+        container_fps = self.props.get("container-fps")
+        slow = bool(fps and container_fps and fps < container_fps * 0.8)
+        return new_drops, slow
+
+    def sample(self):
+        """Returns the new level when it should change, None otherwise"""
+        cpu = self.cpu()
+        drops, slow = self._frame_problems()
+        speed, self.max_speed = self.max_speed, 0.0
+        stalled, self.stalled = self.stalled, False
+        reason = None
+        if cpu > self.cpu_high:
+            reason = f"cpu at {cpu:.0%}"
+        elif drops > self.max_drops:
+            reason = f"{drops} dropped frames"
+        elif slow:
+            reason = "video output can't keep up"
+        elif stalled:
+            reason = f"buffering at {speed / 1024:.0f} KiB/s"
+        if reason is not None:
+            self.good = 0
+            if self.current < self.worst:
+                return self._switch(self.current + 1, reason)
+            return None
+        if self.current <= self.best or cpu > self.cpu_low:
+            self.good = 0
+            return None
+        self.good += 1
+        better = LEVELS[self.current - 1]
+        # no speed measured means everything is cached, that is good enough
+        if speed and speed < better.bitrate * 1.5:
+            self.good = 0
+            return None
+        if self.good < self.stable_samples:
+            return None
+        self.good = 0
+        return self._switch(
+            self.current - 1, f"cpu at {cpu:.0%}, {speed / 1024:.0f} KiB/s"
+        )
+
+    def _switch(self, current, reason):
+        old, self.current = self.level, current
+        LOGGER.info("Quality %s -> %s: %s", old.name, self.level.name, reason)
+        return self.level
@@ -0,0 +1,125 @@
+"""
+Single place for all the deadlines running on the event loop
+"""
+import logging
+
+from heapq import heappush, heappop, heapify
+from itertools import count
+from time import get_clock_info
+
+__all__ = ["Scheduler"]
+
+LOGGER = logging.getLogger(__name__)
+
+WHEN, SEQ, KEY, CALLBACK, ARGS = range(5)
+
+# asyncio runs handles that are due within the clock resolution
+RESOLUTION = get_clock_info("monotonic").resolution
+
+
+class Scheduler:
+    """
+    Timers are kept in one heap and only the earliest of them has a handle
+    on the loop. Every timer has a key, scheduling with a key that is
+    already pending replaces the old timer. Cancelled timers are just
+    marked dead and dropped lazily, so cancel and reschedule are cheap.
+    Everything here has to be called from the loop thread.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._heap = []
+        self._timers = {}
+        self._seq = count()
+        self._handle = None
+        self._armed = None
+
+    def __len__(self):
+        """Number of pending timers"""
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def time(self):
+        return self.loop.time()
+
+    def schedule(self, delay, callback, *args, key=None):
+        return self.schedule_at(self.loop.time() + delay, callback, *args, key=key)
+
+    def schedule_at(self, when, callback, *args, key=None):
+        seq = next(self._seq)
+        if key is None:
+            key = seq
+        self.cancel(key)
+        entry = [when, seq, key, callback, args]
+        self._timers[key] = entry
+        heappush(self._heap, entry)
+        self._arm()
+        return key
+
+    def reschedule(self, key, delay):
+        entry = self._timers.get(key)
+        if entry is None:
+            return False
+        self.schedule(delay, entry[CALLBACK], *entry[ARGS], key=key)
+        return True
+
+    def cancel(self, key):
+        entry = self._timers.pop(key, None)
+        if entry is None:
+            return False
+        entry[CALLBACK] = None
+        # don't let the dead entries pile up when stuff gets cancelled a lot
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._timers):
+            self._heap = list(self._timers.values())
+            heapify(self._heap)
+        return True
+
+    def deadline(self, key):
+        entry = self._timers.get(key)
+        return entry[WHEN] if entry is not None else None
+
+    def remaining(self, key):
+        when = self.deadline(key)
+        return max(when - self.loop.time(), 0.0) if when is not None else None
+
+    def _arm(self):
+        while self._heap and self._heap[0][CALLBACK] is None:
+            heappop(self._heap)
+        if not self._heap:
+            self._disarm()
+            return
+        when = self._heap[0][WHEN]
+        if self._armed is not None and self._armed <= when:
+            return
+        self._disarm()
+        self._armed = when
+        self._handle = self.loop.call_at(when, self._run)
+
+    def _disarm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = None
+        self._armed = None
+
+    def _run(self):
+        self._handle = None
+        self._armed = None
+        now = self.loop.time() + RESOLUTION
+        while self._heap and self._heap[0][WHEN] <= now:
+            entry = heappop(self._heap)
+            callback = entry[CALLBACK]
+            if callback is None:
+                continue
+            del self._timers[entry[KEY]]
+            try:
+                callback(*entry[ARGS])
+            except Exception:
+                LOGGER.exception("Timer %r failed", entry[KEY])
+        self._arm()
+
+    def close(self):
+        self._disarm()
+        self._heap.clear()
+        self._timers.clear()
@@ -0,0 +1,123 @@
+"""
+Machine readable output of the played videos, one JSON object per line
+"""
+import json
+import logging
+import socket
+import sys
+
+from contextlib import suppress
+from queue import Queue, Empty, Full
+from threading import Thread
+from time import sleep
+from weakref import finalize
+
+__all__ = ["EventSink"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+class EventSink:
+    """
+    Events are put into a bounded queue and written in batches by a
+    separate thread, so the capture loop never waits for the reader.
+    When the queue is full the events get dropped and counted in `dropped`.
+    `target` is "-" for stdout, "unix:PATH" for a unix stream socket or
+    a path of a file to append to.
+    """
+
+    maxsize = 4096
+    batch_size = 256
+    reconnect_delay = 1.0
+
+    def __init__(self, target):
+        self.target = target
+        # each counted on one thread only, the emitting one and the writer
+        self.overflowed = 0
+        self.failed = 0
+        self.written = 0
+        self._out = None
+        self._queue = Queue(self.maxsize)
+        self._thread = Thread(daemon=True, target=self._writer, name="EventSink")
+        self._thread.start()
+        self.__finalizer = finalize(self, self._close)
+
+    @property
+    def dropped(self):
+        return self.overflowed + self.failed
+
+    @property
+    def is_stdout(self):
+        return self.target == "-"
+
+    def emit(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.overflowed += 1
+
+    def _open(self):
+        if self.is_stdout:
+            return sys.stdout.buffer
+        if self.target.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.target[5:])
+            except OSError:
+                sock.close()
+                raise
+            return sock.makefile("wb")
+        return open(self.target, "ab")
+
+    def _write(self, data):
+        if self._out is None:
+            try:
+                self._out = self._open()
+            except OSError as ex:
+                LOGGER.warning("Can't open event sink %s: %s", self.target, ex)
+                sleep(self.reconnect_delay)
+                return False
+        try:
+            self._out.write(data)
+            self._out.flush()
+        except OSError as ex:
+            LOGGER.warning("Writing to event sink %s failed: %s", self.target, ex)
+            with suppress(OSError):
+                if not self.is_stdout:
+                    self._out.close()
+            self._out = None
+            return False
+        return True
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            with suppress(Empty):
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            stop = None in batch
+            batch = [e for e in batch if e is not None]
+            if batch:
+                data = "".join(
+                    f"{json.dumps(e, ensure_ascii=False)}\n" for e in batch
+                ).encode("utf8")
+                if self._write(data):
+                    self.written += len(batch)
+                else:
+                    self.failed += len(batch)
+            if stop:
+                return
+
+    def close(self):
+        """Flushes what's left, runs only once"""
+        self.__finalizer()
+
+    def _close(self, timeout=1.0):
+        with suppress(Full):
+            self._queue.put(None, timeout=timeout)
+        self._thread.join(timeout)
+        if self._out is not None and not self.is_stdout:
+            with suppress(OSError):
+                self._out.close()
+        if self.dropped:
+            LOGGER.warning("Event sink dropped %d events", self.dropped)
@@ -0,0 +1,325 @@
+"""
+Capture sources, every one with its own interface, filter and fetcher,
+merged into a single stream of decoded events
+"""
+import asyncio
+import heapq
+import logging
+
+from contextlib import suppress
+from itertools import count
+
+from .capture import (
+    CaptureProcess,
+    PacketFetcherError,
+    PacketFetcherProtocol,
+    fetcher_command,
+)
+from .protocol import ProtocolHandler
+from .stats import STATS
+
+__all__ = ["GAME_FILTER", "CaptureSource", "SourceSet", "parse_source"]
+
+LOGGER = logging.getLogger(__name__)
+
+GAME_FILTER = (
+    "tcp and net 94.23.193.0/24 or net 51.75.130.0/24 or net 37.187.29.0/24 and inbound"
+)
+
+
+def parse_source(spec):
+    """
+    [NETNS/]INTERFACE[=FILTER], the interface can be left out
+    to capture on the default one with a different filter
+    """
+    where, _, bpf = spec.partition("=")
+    netns, _, interface = where.rpartition("/")
+    return interface or None, bpf or GAME_FILTER, netns or None
+
+
+class CaptureSource:
+    """
+    Runs one fetcher and decodes what it captures, either on the loop
+    or in a `CaptureProcess`. A fetcher that fails after it has been
+    running for `healthy_after` seconds gets restarted, with the delay
+    doubling every time it fails again before that. One that fails
+    right on the first start is most likely misconfigured and isn't
+    restarted at all.
+    """
+
+    healthy_after = 10.0
+    max_restarts = 5
+    backoff = 1.0
+    max_backoff = 60.0
+
+    def __init__(
+        self,
+        loop,
+        name,
+        interface=None,
+        bpf=GAME_FILTER,
+        netns=None,
+        process=False,
+        fetcher=None,
+    ):
+        self.loop = loop
+        self.name = name
+        self.interface = interface
+        self.filter = bpf
+        self.netns = netns
+        self.process = process
+        self.fetcher = fetcher
+        self.state = "idle"
+        self.stopped = False
+        self.error_data = str()
+        self.last_error = str()
+        self.started = None
+        self.transport = None
+        self.capture = None
+        self._protocol = None
+        self._stop = asyncio.Event()
+        self.restarts = STATS.counter(
+            "mouselounge_capture_source_restarts_total",
+            "Times the fetcher of the source got restarted",
+            source=name,
+        )
+        self.events_total = STATS.counter(
+            "mouselounge_capture_source_events_total",
+            "Decoded events of the source",
+            source=name,
+        )
+        STATS.gauge(
+            "mouselounge_capture_source_up",
+            "Whether the fetcher of the source is running",
+            lambda: int(self.state == "running"),
+            source=name,
+        )
+
+    def command(self):
+        args, framer = fetcher_command(self.fetcher)
+        if self.interface is not None:
+            args = args + ["-i", self.interface]
+        if self.netns is not None:
+            args = ["ip", "netns", "exec", self.netns] + args
+        return args + [self.filter], framer
+
+    async def _run(self):
+        args, framer = self.command()
+        if self.process:
+            self.capture = CaptureProcess(self.loop, args, framer)
+            self.capture.start()
+            async for event in self.capture.events():
+                yield event
+            return
+        self.transport, self._protocol = await self.loop.subprocess_exec(
+            lambda: PacketFetcherProtocol(self.loop, framer()),
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stdin=None,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        protohandler = ProtocolHandler()
+        async for ts, line in self._protocol.yielder():
+            for key, data in protohandler.decode(line):
+                yield key, data, ts, None
+        if not self.stopped:
+            # stderr can still be on its way when stdout closes
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.shield(self._protocol.closed), 1.0)
+
+    def _end_run(self):
+        """Error of the run that just ended"""
+        if self.capture is not None:
+            error = self.capture.error_data
+            self.capture.close()
+            self.capture = None
+            return error
+        if self.transport is not None and not self.stopped:
+            # a stopped one is left to the shutdown, so it can be waited for
+            with suppress(ProcessLookupError):
+                self.transport.terminate()
+            self.transport.close()
+            self.transport = None
+        protocol, self._protocol = self._protocol, None
+        return protocol.error_data if protocol is not None else ""
+
+    async def events(self):
+        """Yields (key, data, capture time, decode time) tuples"""
+        failures = 0
+        runs = 0
+        while not self.stopped:
+            runs += 1
+            self.state = "running"
+            self.started = self.loop.time()
+            try:
+                async for event in self._run():
+                    self.events_total.inc()
+                    yield event
+            except PacketFetcherError as ex:
+                self.last_error = str(ex)
+            else:
+                self.last_error = ""
+            finally:
+                error = self._end_run()
+            self.last_error = self.last_error or error
+            if not self.last_error or self.stopped:
+                break
+            ran = self.loop.time() - self.started
+            if runs == 1 and ran < self.healthy_after:
+                # most likely misconfigured, restarting won't help
+                break
+            failures = 1 if ran >= self.healthy_after else failures + 1
+            if failures > self.max_restarts:
+                break
+            delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+            self.state = "backoff"
+            LOGGER.warning(
+                "Capture source %s failed: %s, restarting in %.0fs",
+                self.name,
+                self.last_error.strip(),
+                delay,
+            )
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stop.wait(), delay)
+            self.restarts.inc()
+        if self.last_error and not self.stopped:
+            self.state = "failed"
+            self.error_data = self.last_error
+            LOGGER.error("Gave up on capture source %s", self.name)
+        else:
+            self.state = "done"
+
+    def stop(self):
+        self.stopped = True
+        self._stop.set()
+        if self._protocol is not None:
+            self._protocol.stopped = True
+
+    def close(self, timeout=2.0):
+        self.stop()
+        if self.capture is not None:
+            self.capture.close(timeout=timeout)
+        with suppress(ProcessLookupError, AttributeError):
+            self.transport.terminate()
+
+    def health(self):
+        return {
+            "name": self.name,
+            "interface": self.interface,
+            "netns": self.netns,
+            "filter": self.filter,
+            "state": self.state,
+            "uptime": self.loop.time() - self.started
+            if self.state == "running"
+            else 0.0,
+            "restarts": self.restarts.value,
+            "events": self.events_total.value,
+            "last_error": self.last_error.strip(),
+        }
+
+
+class SourceSet:
+    """
+    Merges the events of all the sources. Events that arrive within
+    `reorder_window` seconds of each other come out in the order of
+    their capture time. A lone source skips the reordering and with
+    it the delay.
+    """
+
+    reorder_window = 0.02
+
+    def __init__(self, loop, sources):
+        self.loop = loop
+        self.sources = sources
+        self._heap = []
+        self._seq = count()
+        self._running = 0
+        self._waiter = None
+
+    @property
+    def stopped(self):
+        return all(source.stopped for source in self.sources)
+
+    @property
+    def error_data(self):
+        return "".join(
+            f"{source.name}: {source.error_data.strip()}\n"
+            if len(self.sources) > 1
+            else source.error_data
+            for source in self.sources
+            if source.error_data
+        )
+
+    @property
+    def transports(self):
+        return [s.transport for s in self.sources if s.transport is not None]
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def _pump(self, source):
+        try:
+            async for event in source.events():
+                release = self.loop.time() + self.reorder_window
+                heapq.heappush(self._heap, (event[2], next(self._seq), release, event))
+                self._wakeup()
+        finally:
+            self._running -= 1
+            self._wakeup()
+
+    async def events(self):
+        """Yields (key, data, capture time, decode time) tuples"""
+        if len(self.sources) == 1:
+            async for event in self.sources[0].events():
+                yield event
+            return
+        self._running = len(self.sources)
+        pumps = [self.loop.create_task(self._pump(s)) for s in self.sources]
+        try:
+            while self._running or self._heap:
+                now = self.loop.time()
+                while self._heap and (not self._running or self._heap[0][2] <= now):
+                    yield heapq.heappop(self._heap)[3]
+                if not self._running:
+                    continue
+                self._waiter = self.loop.create_future()
+                timer = None
+                if self._heap:
+                    timer = self.loop.call_at(self._heap[0][2], self._wakeup)
+                try:
+                    await self._waiter
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+        finally:
+            for pump in pumps:
+                pump.cancel()
+
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+
+    def close(self, timeout=2.0):
+        for source in self.sources:
+            source.close(timeout)
+
+    def health(self):
+        return [source.health() for source in self.sources]
+
+    @classmethod
+    def from_specs(cls, loop, specs, process=False, fetcher=None):
+        """Sources of the --source arguments, the game servers on the default
+        interface if there aren't any"""
+        sources = []
+        for spec in specs or ("",):
+            interface, bpf, netns = parse_source(spec)
+            name = "/".join(filter(None, (netns, interface))) or "default"
+            taken = sum(s.name.split("#")[0] == name for s in sources)
+            if taken:
+                name = f"{name}#{taken + 1}"
+            sources.append(
+                CaptureSource(loop, name, interface, bpf, netns, process, fetcher)
+            )
+        LOGGER.debug("Capture sources: %s", ", ".join(s.name for s in sources))
+        return cls(loop, sources)
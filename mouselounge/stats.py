@@ -0,0 +1,162 @@
+"""
+Runtime counters and gauges, served in the prometheus text format
+"""
+import asyncio
+import logging
+
+from collections import OrderedDict
+from contextlib import suppress
+
+__all__ = ["Counter", "Gauge", "Registry", "STATS", "serve"]
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """
+    Plain attribute increment, no locks. Nearly everything is counted
+    on the loop thread and the GIL takes care of the rest well enough.
+    """
+
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, num=1):
+        self.value += num
+
+
+class Gauge:
+    """Either set directly or computed by `func` when it's read"""
+
+    __slots__ = ("value", "func")
+    kind = "gauge"
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+
+class Registry:
+    def __init__(self):
+        self.families = OrderedDict()
+
+    def _get(self, cls, name, doc, labels, **kw):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (cls.kind, doc, OrderedDict())
+        elif family[0] != cls.kind:
+            raise ValueError(f"{name} is already a {family[0]}")
+        key = _labels(labels)
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = cls(**kw)
+        return metric
+
+    def counter(self, name, doc, **labels):
+        """Returns the counter, creating it on the first call"""
+        return self._get(Counter, name, doc, labels)
+
+    def gauge(self, name, doc, func=None, **labels):
+        """Returns the gauge, `func` replaces the one already registered"""
+        gauge = self._get(Gauge, name, doc, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def value(self, name, **labels):
+        metric = self.families[name][2][_labels(labels)]
+        return metric.get() if metric.kind == "gauge" else metric.value
+
+    def snapshot(self):
+        """Current values keyed by the names the text format uses"""
+        values = {}
+        for name, (kind, _doc, metrics) in self.families.items():
+            for labels, metric in metrics.items():
+                if labels:
+                    labels = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    key = f"{name}{{{labels}}}"
+                else:
+                    key = name
+                with suppress(Exception):
+                    values[key] = metric.get() if kind == "gauge" else metric.value
+        return values
+
+    def render(self):
+        lines = []
+        for name, (kind, doc, metrics) in self.families.items():
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics.items():
+                if kind == "gauge":
+                    try:
+                        value = metric.get()
+                    except Exception:
+                        LOGGER.exception("Failed to read gauge %s", name)
+                        continue
+                else:
+                    value = metric.value
+                if labels:
+                    labels = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    lines.append(f"{name}{{{labels}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+STATS = Registry()
+
+
+async def _handle_client(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+        if path.split(b"?")[0] in (b"/", b"/metrics"):
+            status, body = "200 OK", STATS.render().encode("utf8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except asyncio.LimitOverrunError:
+        LOGGER.debug("Stats request was too big")
+    finally:
+        with suppress(Exception):
+            writer.close()
+
+
+async def serve(address):
+    """
+    Serves the metrics over HTTP on `address`, which is either unix:PATH
+    or [HOST:]PORT, the host defaults to the loopback.
+    """
+    if address.startswith("unix:"):
+        return await asyncio.start_unix_server(_handle_client, address[5:])
+    host, _, port = address.rpartition(":")
+    return await asyncio.start_server(_handle_client, host or "127.0.0.1", int(port))
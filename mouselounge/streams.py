@@ -0,0 +1,117 @@
+"""
+Resolving direct stream urls with youtube-dl ahead of mpv
+"""
+import logging
+import re
+
+from collections import namedtuple
+from functools import partial
+from time import time
+
+from cachetools import LRUCache
+
+from .utils import u8str
+from .stats import STATS
+
+__all__ = ["Stream", "StreamResolver"]
+
+LOGGER = logging.getLogger(__name__)
+
+EXPIRE = re.compile(r"[?&/]expire[=/](\d+)")
+
+Stream = namedtuple("Stream", ("urls", "expires"))
+
+CACHE_HITS = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="stream", result="hit"
+)
+CACHE_MISSES = STATS.counter(
+    "mouselounge_cache_requests_total", "Cache lookups", cache="stream", result="miss"
+)
+
+
+class StreamResolver:
+    """
+    Runs `youtube-dl -g` in the processor pool as soon as we know about the
+    video and keeps the results around until the signed urls expire.
+    Every callback passed to `resolve` is called on the event loop with
+    either a `Stream` or None when youtube-dl failed.
+    """
+
+    # used when youtube-dl gives us urls without any expiry info
+    ttl = 30 * 60
+    # don't hand out urls that will expire before the video is over
+    margin = 10 * 60
+
+    def __init__(self, helper, fmt, maxsize=64):
+        self.helper = helper
+        self.fmt = fmt
+        self.cache = LRUCache(maxsize=maxsize)
+        self.pending = {}
+
+    def key(self, video, fmt=None):
+        return video.id, fmt or self.fmt
+
+    def get(self, video, fmt=None):
+        key = self.key(video, fmt)
+        stream = self.cache.get(key)
+        if stream is None:
+            return None
+        if stream.expires - self.margin < time():
+            del self.cache[key]
+            return None
+        return stream
+
+    def resolve(self, video, callback=None, fmt=None):
+        key = self.key(video, fmt)
+        stream = self.get(video, fmt)
+        if stream is not None:
+            CACHE_HITS.inc()
+            if callback:
+                callback(stream)
+            return
+        CACHE_MISSES.inc()
+        waiters = self.pending.get(key)
+        if waiters is not None:
+            if callback:
+                waiters.append(callback)
+            return
+        self.pending[key] = [callback] if callback else []
+        LOGGER.debug("Resolving stream for %s", key)
+        self.helper.run_process(
+            partial(self._process_callback, key),
+            "youtube-dl",
+            "--no-playlist",
+            "-g",
+            "-f",
+            key[1],
+            video.url,
+        )
+
+    def _process_callback(self, key, response):
+        # processor callbacks are called from the pool's result thread
+        self.helper.call_soon_threadsafe(self._resolved, key, response)
+
+    def _resolved(self, key, response):
+        retcode, stdout, stderr = response
+        urls = tuple(u8str(stdout).split())
+        stream = None
+        if retcode or not urls:
+            LOGGER.warning(
+                "Couldn't resolve stream for %s, mpv will do it:\n%s",
+                key[0],
+                u8str(stderr).strip(),
+            )
+        else:
+            stream = Stream(urls, self.expiry(urls))
+            self.cache[key] = stream
+        for callback in self.pending.pop(key, ()):
+            try:
+                callback(stream)
+            except Exception:
+                LOGGER.exception("Failed to call stream callback for %s", key[0])
+
+    def expiry(self, urls):
+        expires = [int(m.group(1)) for m in map(EXPIRE.search, urls) if m]
+        if expires:
+            return min(expires)
+        return time() + self.ttl
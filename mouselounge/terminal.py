@@ -0,0 +1,109 @@
+"""
+Terminal output of the managers, written from a thread a frame at a time
+"""
+import re
+import sys
+import threading
+
+from contextlib import suppress
+from time import sleep
+
+from colorama import Style
+
+from .stats import STATS
+
+__all__ = ["Renderer"]
+
+ANSI = re.compile(r"\x1b\[[0-9;]*m")
+
+FRAMES = STATS.counter("mouselounge_terminal_frames_total", "Writes to the terminal")
+MERGED = STATS.counter(
+    "mouselounge_terminal_merged_total", "Lines merged into an earlier one"
+)
+DROPPED = STATS.counter(
+    "mouselounge_terminal_dropped_total", "Lines dropped because the terminal is stuck"
+)
+
+
+class Renderer:
+    """
+    `echo` only queues the line, a thread writes everything queued in
+    one go, at most `fps` times a second. Lines with the same key that
+    come within one frame become the last of them with a count. Colors
+    get reset after every line on a terminal and stripped anywhere else.
+    """
+
+    fps = 20
+    max_lines = 1000
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        if self.tty and sys.platform == "win32":
+            # pylint: disable=import-outside-toplevel
+            from colorama import just_fix_windows_console
+
+            just_fix_windows_console()
+        # [key, line, count] of every queued line
+        self._pending = []
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(daemon=True, target=self._run, name="Renderer")
+        self._thread.start()
+
+    def echo(self, line, key=None):
+        with self._lock:
+            entry = self._keys.get(key) if key is not None else None
+            if entry is not None:
+                entry[1] = line
+                entry[2] += 1
+                MERGED.inc()
+            else:
+                if len(self._pending) >= self.max_lines:
+                    dropped = self._pending.pop(0)
+                    self._keys.pop(dropped[0], None)
+                    DROPPED.inc()
+                entry = [key, line, 1]
+                self._pending.append(entry)
+                if key is not None:
+                    self._keys[key] = entry
+        self._wake.set()
+
+    def render(self, line, count):
+        if count > 1:
+            text = line.rstrip("\n")
+            line = f"{text} ({count} times){line[len(text):]}"
+        if not self.tty:
+            return f"{ANSI.sub('', line)}\n"
+        if "\x1b[" in line:
+            return f"{line}{Style.RESET_ALL}\n"
+        return f"{line}\n"
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._keys.clear()
+        if not pending:
+            return
+        text = "".join(self.render(line, count) for _key, line, count in pending)
+        with suppress(OSError, ValueError):
+            self.stream.write(text)
+            self.stream.flush()
+        FRAMES.inc()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+            # whatever comes in the meantime goes out with the next frame
+            sleep(1 / self.fps)
+
+    def close(self):
+        """Writes out what's left"""
+        self._closed = True
+        self._wake.set()
+        self._thread.join(1 / self.fps + 1.0)
+        self.flush()
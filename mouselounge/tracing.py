@@ -0,0 +1,131 @@
+"""
+Following the videos through the pipeline, from the captured packet
+to the first frame in mpv.
+"""
+import logging
+
+from bisect import bisect_left
+from collections import OrderedDict
+from time import time
+
+__all__ = ["STAGES", "Trace", "Traced", "Histogram", "Tracer", "TRACER"]
+
+LOGGER = logging.getLogger(__name__)
+
+STAGES = (
+    "capture",
+    "decode",
+    "dispatch",
+    "metadata",
+    "loadfile",
+    "file-loaded",
+    "playback-restart",
+)
+
+
+class Trace:
+    """Wall clock times at which the event got through each of the stages"""
+
+    __slots__ = ("stamps",)
+
+    def __init__(self, capture_ts=None):
+        self.stamps = OrderedDict()
+        self.stamps["capture"] = capture_ts if capture_ts is not None else time()
+
+    def stamp(self, stage, ts=None):
+        if stage not in self.stamps:
+            self.stamps[stage] = ts if ts is not None else time()
+        return self
+
+    def latencies(self):
+        """Yields (stage, seconds since the previous stage)"""
+        prev = None
+        for stage, ts in self.stamps.items():
+            if prev is not None:
+                yield stage, ts - prev
+            prev = ts
+
+    @property
+    def total(self):
+        return next(reversed(self.stamps.values())) - self.stamps["capture"]
+
+    def __repr__(self):
+        stages = ", ".join(f"{s} +{l * 1000:.1f}ms" for s, l in self.latencies())
+        return f"<Trace {stages}>"
+
+
+class Traced(tuple):
+    """Data tuple that carries its trace through the listeners"""
+
+    def __new__(cls, data, trace):
+        inst = super().__new__(cls, data)
+        inst.trace = trace
+        return inst
+
+
+class Histogram:
+    """
+    Log scaled buckets in milliseconds, each one is about 19% wider
+    than the previous one, from 0.1 ms to a bit over 2 minutes.
+    """
+
+    bounds = [0.1 * 2 ** (i / 4) for i in range(82)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        msecs = seconds * 1000
+        self.counts[bisect_left(self.bounds, msecs)] += 1
+        self.count += 1
+        self.sum += msecs
+        self.max = max(self.max, msecs)
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for idx, num in enumerate(self.counts):
+            seen += num
+            if seen >= rank:
+                return min(self.bounds[min(idx, len(self.bounds) - 1)], self.max)
+        return self.max
+
+    def __str__(self):
+        if not self.count:
+            return "no samples"
+        return (
+            f"n={self.count} avg={self.sum / self.count:.1f} "
+            f"p50={self.percentile(50):.1f} p90={self.percentile(90):.1f} "
+            f"p99={self.percentile(99):.1f} max={self.max:.1f} ms"
+        )
+
+
+class Tracer:
+    """Keeps latency histograms of every stage of the finished traces"""
+
+    def __init__(self):
+        self.histograms = OrderedDict((stage, Histogram()) for stage in STAGES[1:])
+        self.histograms["total"] = Histogram()
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        for stage, latency in trace.latencies():
+            # clock of the capture and ours may disagree a bit
+            self.histograms[stage].record(max(latency, 0.0))
+        self.histograms["total"].record(max(trace.total, 0.0))
+        LOGGER.debug("Finished %r", trace)
+
+    def dump(self):
+        lines = ["Stage latencies (time since the previous stage):"]
+        for stage, hist in self.histograms.items():
+            lines.append(f"  {stage:>16}: {hist}")
+        return "\n".join(lines)
+
+
+TRACER = Tracer()
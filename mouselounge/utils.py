@@ -22,18 +22,22 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 # pylint: disable=invalid-name
+import asyncio
+import ctypes
 import logging
-import socket
 import json
 import os
+import re
 import string
+import struct
 
+from collections import namedtuple, defaultdict
 from stat import S_ISSOCK
 from contextlib import suppress
 from tempfile import gettempdir
 from functools import lru_cache
+from itertools import chain, count
 from weakref import finalize
-from threading import Thread
 from random import choices
 
 
@@ -41,7 +45,16 @@ from requests import Session
 
 from ._version import __version__
 
-__all__ = ["requests", "get_text", "get_json", "rand_string", "MPV_IPC_Client"]
+__all__ = [
+    "requests",
+    "get_text",
+    "get_json",
+    "rand_string",
+    "Video",
+    "wait_for_file",
+    "MPVError",
+    "MPV_IPC_Client",
+]
 
 LOGGER = logging.getLogger(__name__)
 
@@ -71,58 +84,286 @@ def rand_string(length):
     return "".join(choices(string.ascii_letters + string.digits, k=length))
 
 
+VIDEO_ID = re.compile(
+    r"(?:youtu\.be/|youtube\.com/(?:v/|embed/|shorts/|watch\?(?:\S*?&)?v=))([\w-]{11})"
+)
+VIDEO_PARAMS = re.compile(r"[?&#](t|start|list)=([\w-]+)")
+TIMESTAMP = re.compile(r"(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$")
+
+
+class Video(namedtuple("Video", ("id", "start", "playlist"))):
+    """
+    Canonical form of a posted youtube link. `id` is the only thing
+    that should be used as a key for cooldowns and caches, `start` is
+    the offset in seconds and `playlist` is the list id, if there was any.
+    """
+
+    __slots__ = ()
+
+    watch_url = "https://www.youtube.com/watch?v={}"
+
+    @classmethod
+    def from_url(cls, url):
+        match = VIDEO_ID.search(url)
+        if not match:
+            return None
+        start, playlist = 0.0, None
+        # the parameters can come before the id too, like in watch?t=30&v=
+        for key, val in VIDEO_PARAMS.findall(url):
+            if key == "list":
+                playlist = val
+            else:
+                start = cls.parse_start(val)
+        return cls(match.group(1), start, playlist)
+
+    @classmethod
+    def from_id(cls, vid):
+        return cls(vid, 0.0, None)
+
+    @staticmethod
+    def parse_start(val):
+        match = TIMESTAMP.match(val)
+        if match is None:
+            return 0.0
+        hours, mins, secs = match.groups()
+        return float(int(hours or 0) * 3600 + int(mins or 0) * 60 + int(secs or 0))
+
+    @property
+    def url(self):
+        return self.watch_url.format(self.id)
+
+
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _inotify_init(directory):
+    """Returns inotify fd watching for new files in the directory or None"""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _inotify_names(fd):
+    with suppress(BlockingIOError):
+        data = os.read(fd, 4096)
+        offset = 0
+        while offset < len(data):
+            _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            yield os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+
+async def wait_for_file(path, check=os.path.exists):
+    """
+    Waits until `check(path)` is true, the parent directory is watched
+    with inotify so there is no polling involved. When inotify isn't
+    avaliable we fall back to checking the path every 50 ms.
+    """
+    directory, name = os.path.split(path)
+    fd = _inotify_init(directory or ".")
+    if fd is None:
+        while not check(path):
+            await asyncio.sleep(0.05)
+        return
+    loop = asyncio.get_running_loop()
+    created = asyncio.Event()
+
+    def on_event():
+        if name in set(_inotify_names(fd)):
+            created.set()
+
+    loop.add_reader(fd, on_event)
+    try:
+        # the file might have been created before we started watching
+        while not check(path):
+            await created.wait()
+            created.clear()
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+class MPVError(Exception):
+    def __init__(self, error, command=()):
+        super().__init__()
+        self.error = error
+        self.command = command
+
+    def __str__(self):
+        return f"{self.error} ({' '.join(map(str, self.command))})"
+
+
 class MPV_IPC_Client:
+    """
+    Client for mpv's JSON IPC that runs on the asyncio loop.
+    Every function in `cbset` gets called with each message mpv sends us,
+    `wait_event` can be used to await a specific event instead.
+    """
 
-    recv_size = 2 ** 10
+    recv_size = 2 ** 16
 
     def __init__(self):
         self.connected = False
         self.tmp_dir = os.environ.get("XDG_RUNTIME_DIR") or gettempdir()
         self.socket_file = self.create_tmp_filepath("mpvipcsocket", True)
-        self._soc = socket.socket(socket.AF_UNIX)
-        self._soc.settimeout(1)
         self.__fileset = set()
         self.__finalizer = finalize(self, self.clean_exit)
-        self._receiving_task = Thread(daemon=True, target=self._receiver)
+        self._writer = None
+        self._connecting_task = None
+        self._receiving_task = None
+        self._connected_event = None
+        self._event_waiters = defaultdict(list)
+        self._pending = {}
+        self._request_ids = count(1)
+        self.observed = []
         self.cbset = set()
 
-    def _receiver(self):
-        while self.connected:
+    @property
+    def connected_event(self):
+        # created lazily so it ends up on the loop that is actually running
+        if self._connected_event is None:
+            self._connected_event = asyncio.Event()
+        return self._connected_event
+
+    async def _receiver(self, reader):
+        # there might be no loop to ask anymore once the finally runs
+        task = asyncio.current_task()
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = await reader.read(self.recv_size)
+                if not chunk:
+                    break
+                start = len(buffer)
+                buffer += chunk
+                # only the new chunk can contain the end of a line
+                end = buffer.find(b"\n", start)
+                begin = 0
+                while end != -1:
+                    self._handle_line(buffer[begin:end])
+                    begin = end + 1
+                    end = buffer.find(b"\n", begin)
+                del buffer[:begin]
+        except ConnectionError as ex:
+            LOGGER.debug("mpv connection lost: %s", ex)
+        finally:
+            # a newer connection isn't ours to tear down
+            if self._receiving_task is task:
+                self._set_disconnected()
+
+    def _handle_line(self, line):
+        if not line.strip():
+            return
+        try:
+            resp = json.loads(line)
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            LOGGER.exception("Error during decoding for line:\n%s", line)
+            return
+        try:
+            self._dispatch(resp)
+        except Exception:
+            LOGGER.exception("Failed to dispatch mpv message %s", resp)
+
+    def _dispatch(self, resp):
+        request_id = resp.get("request_id")
+        if request_id is not None and "event" not in resp:
+            fut = self._pending.pop(request_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(resp)
+        for cb in self.cbset:
             try:
-                received = self._soc.recv(self.recv_size).split(b"\n")
-            except socket.timeout:
-                continue
-            for resp in [resp for resp in received if resp.strip()]:
+                cb(resp)
+            except Exception:
+                LOGGER.exception("mpv callback %r failed with %s", cb, resp)
+        etype = resp.get("event")
+        if etype:
+            for fut in self._event_waiters.pop(etype, ()):
+                if not fut.done():
+                    fut.set_result(resp)
+        error = resp.get("error")
+        if error and error != "success":
+            LOGGER.debug("mpv returned error: %s", resp)
+
+    def wait_event(self, name):
+        """Returns a future that gets resolved with the next `name` event"""
+        fut = asyncio.get_running_loop().create_future()
+        self._event_waiters[name].append(fut)
+        return fut
+
+    async def connect(self):
+        """Does nothing while an earlier connect is still waiting for mpv"""
+        if self._connecting_task is not None and not self._connecting_task.done():
+            return
+        task = self._connecting_task = asyncio.current_task()
+        try:
+            await wait_for_file(self.socket_file, self.is_socket_avaliable)
+            delay = 0.01
+            while True:
                 try:
-                    resp = json.loads(resp)
-                except json.decoder.JSONDecodeError:
-                    LOGGER.exception("Error during decoding for line:\n%s", resp)
-                    continue
-                for cb in self.cbset:
-                    cb(resp)
-                error = resp.get("error")
-                if error and error != "success":
-                    raise ConnectionError(error)
-
-    def connect(self):
+                    reader, self._writer = await asyncio.open_unix_connection(
+                        self.socket_file
+                    )
+                    break
+                except ConnectionRefusedError:
+                    # socket is bound but mpv doesn't listen on it just yet
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.5)
+        finally:
+            if self._connecting_task is task:
+                self._connecting_task = None
+        # observers go out before any of the queued commands
+        for num, name in enumerate(self.observed, 1):
+            self._write({"command": ["observe_property", num, name]})
+        self.connected = True
+        self.connected_event.set()
+        self._receiving_task = asyncio.ensure_future(self._receiver(reader))
+
+    def observe(self, name):
+        """Property changes of `name` will be sent as events on every connection"""
+        if name in self.observed:
+            return
+        self.observed.append(name)
+        if self.connected:
+            self._write({"command": ["observe_property", len(self.observed), name]})
+
+    def _write(self, data):
+        data = dict(data, request_id=next(self._request_ids))
+        self._writer.write(f"{json.dumps(data)}\n".encode("utf8"))
+        return data["request_id"]
+
+    async def send_data(self, data):
+        """
+        Sends the command and waits for mpv to reply to it. Every command
+        is tagged with its own `request_id` so replies can't get mixed up.
+        """
+        await self.connected_event.wait()
+        request_id = self._write(data)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = fut
         try:
-            self._soc.connect(self.socket_file)
-            self.connected = True
-            self._receiving_task.start()
-        except (OSError, RuntimeError):
-            self.connected = False
-            self._receiving_task.join()
-            self._soc = socket.socket(socket.AF_UNIX)
-            self._soc.settimeout(1)
-            self._soc.connect(self.socket_file)
-            self.connected = True
-            self._receiving_task = Thread(daemon=True, target=self._receiver)
-            self._receiving_task.start()
-
-    def send_data(self, data):
-        data = f"{json.dumps(data)}\n"
-        data = data.encode("utf8")
-        self._soc.send(data)
+            await self._writer.drain()
+            return await fut
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def command(self, *args):
+        """Runs the command and returns its data, raises MPVError on failure"""
+        resp = await self.send_data({"command": list(args)})
+        error = resp.get("error")
+        if error and error != "success":
+            raise MPVError(error, args)
+        return resp.get("data")
 
     def create_tmp_filepath(self, fname, is_socket=False):
         if not isinstance(fname, str):
@@ -134,9 +375,9 @@ class MPV_IPC_Client:
             return tmp_file
         raise RuntimeError("Couldn't find any temp dirs on your system")
 
-    def is_socket_avaliable(self):
+    def is_socket_avaliable(self, path=None):
         with suppress(FileNotFoundError):
-            return S_ISSOCK(os.stat(self.socket_file).st_mode)
+            return S_ISSOCK(os.stat(path or self.socket_file).st_mode)
         return False
 
     def clean_exit(self):
@@ -149,13 +390,29 @@ class MPV_IPC_Client:
             with suppress(FileNotFoundError):
                 os.remove(file)
 
-    def disconnect(self):
+    def _set_disconnected(self):
         self.connected = False
-        with suppress(RuntimeError):
-            self._receiving_task.join()
-        with suppress(OSError):
-            self.send_data({"command": ["quit"]})
-            self._soc.shutdown(socket.SHUT_RDWR)
-            self._soc.close()
+        if self._connected_event is not None:
+            self._connected_event.clear()
+        waiters, self._event_waiters = self._event_waiters, defaultdict(list)
+        pending, self._pending = self._pending, {}
+        for fut in chain(pending.values(), *waiters.values()):
+            with suppress(RuntimeError):
+                fut.cancel()
+
+    def disconnect(self):
+        writer, self._writer = self._writer, None
+        task, self._receiving_task = self._receiving_task, None
+        connecting, self._connecting_task = self._connecting_task, None
+        self._set_disconnected()
+        # this might run after the loop is closed, so all of it is best effort
+        with suppress(Exception):
+            task.cancel()
+        with suppress(Exception):
+            connecting.cancel()
+        with suppress(Exception):
+            writer.write(b'{"command": ["quit"]}\n')
+        with suppress(Exception):
+            writer.close()
         with suppress(FileNotFoundError):
             os.remove(self.socket_file)
@@ -0,0 +1,67 @@
+"""
+Stand-ins for what the capture programs print, shared with the benchmarks
+"""
+import string
+import struct
+
+__all__ = ["ID_CHARS", "PcapWriter", "TcpflowWriter", "tribehouse_payload"]
+
+ID_CHARS = string.ascii_letters + string.digits + "-_"
+# game server to us, for the packets that don't come from a recording
+FLOW = "094.023.193.010.05555-192.168.001.002.51234"
+
+
+def parse_flow(flow):
+    """Addresses and ports back out of a tcpflow flow name"""
+    ends = []
+    for end in flow.split("-"):
+        *addr, port = end.split(".")
+        ends += [bytes(int(octet) for octet in addr), int(port)]
+    return ends
+
+
+class PcapWriter:
+    """Same stream tcpdump -Uw- writes, with made up ethernet frames"""
+
+    header = struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 262144, 1)
+    record = struct.Struct("<IIII")
+    ethernet = bytes(12) + b"\x08\x00"
+    ip = struct.Struct(">BBHHHBBH4s4s")
+    tcp = struct.Struct(">HHIIBBHHH")
+
+    def __init__(self, out):
+        self.out = out
+        self.out.write(self.header)
+
+    def write(self, payload, ts, flow=None):
+        src, sport, dst, dport = parse_flow(flow or FLOW)
+        size = self.ip.size + self.tcp.size + len(payload)
+        data = b"".join(
+            (
+                self.ethernet,
+                self.ip.pack(0x45, 0, size, 0, 0, 64, 6, 0, src, dst),
+                self.tcp.pack(sport, dport, 0, 0, 0x50, 0x18, 65535, 0, 0),
+                payload,
+            )
+        )
+        sec = int(ts)
+        self.out.write(
+            self.record.pack(sec, int((ts - sec) * 1e6), len(data), len(data)) + data
+        )
+        self.out.flush()
+
+
+class TcpflowWriter:
+    """Same output tcpflow -cB prints, every packet after the name of its flow"""
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, payload, _ts, flow=None):
+        self.out.write(f"{flow or FLOW}: ".encode("ascii") + payload + b"\n")
+        self.out.flush()
+
+
+def tribehouse_payload(vid):
+    # opcode the protocol handler looks for followed by the 43 character link
+    return b"\x00\x3a\x1a\x0c\x01" + f"https://www.youtube.com/watch?v={vid}".encode()
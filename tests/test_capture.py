@@ -0,0 +1,128 @@
+"""
+The capture process wakes the loop up through a pipe, whatever way the
+publishes and the reads of the ring interleave, none of them can get lost
+"""
+import asyncio
+import multiprocessing as mp
+import os
+import random
+
+from time import monotonic, sleep
+
+import pytest
+
+from mouselounge.capture import CaptureProcess, RingBuffer, _Publisher
+
+CAPACITY = 2 ** 23
+BURSTS = 3000
+# longer than any wakeup takes, a reader that sleeps through it is stuck
+STALL = 2.0
+
+
+def caught_up(ring):
+    """False if the reader sleeps on records it didn't get woken up for"""
+    deadline = monotonic() + STALL
+    while ring.pending:
+        if monotonic() > deadline:
+            return False
+        sleep(0)
+    return True
+
+
+def produce(ring_name, conn, seed):
+    """Publishes bursts, some of them only once the reader caught up"""
+    rng = random.Random(seed)
+    ring = RingBuffer(CAPACITY, ring_name)
+    fd = conn.fileno()
+    os.set_blocking(fd, False)
+    publisher = _Publisher(None, ring, fd)
+    sent = 0
+    try:
+        for _ in range(BURSTS):
+            for _ in range(rng.randrange(1, 4)):
+                # big ones take a while to land in the ring
+                data = bytes(rng.choice((0, 0, 2 ** 18)))
+                publisher.publish(("event", sent, data, 0.0, 0.0))
+                sent += 1
+            if rng.random() < 0.5 and not caught_up(ring):
+                return 1
+        if not caught_up(ring):
+            return 1
+        publisher.publish(("event", "sent", sent, 0.0, 0.0))
+        return 0
+    finally:
+        ring.close()
+        conn.close()
+
+
+def _producer_main(ring_name, conn, seed):
+    os._exit(produce(ring_name, conn, seed))
+
+
+def _writer_main(ring_name, seconds):
+    ring = RingBuffer(2 ** 16, ring_name)
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        ring.put(b"x")
+    ring.close()
+    os._exit(0)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_no_wakeup_gets_lost(loop, seed):
+    ctx = mp.get_context("spawn")
+    capture = CaptureProcess(loop, None, None)
+    capture.ring = RingBuffer(CAPACITY)
+    capture._conn, child_conn = ctx.Pipe(duplex=False)
+    producer = ctx.Process(
+        target=_producer_main, args=(capture.ring.name, child_conn, seed)
+    )
+    producer.start()
+    child_conn.close()
+    loop.add_reader(capture._conn.fileno(), capture._readable)
+    rng = random.Random(seed)
+
+    async def consume():
+        received = []
+        async for key, data, *_rest in capture.events():
+            received.append((key, data))
+            # hand the loop over now and then, like the dispatch does
+            if rng.random() < 0.3:
+                await asyncio.sleep(0)
+        return received
+
+    try:
+        received = loop.run_until_complete(asyncio.wait_for(consume(), 60))
+    finally:
+        producer.join(10)
+        capture.close()
+    assert producer.exitcode == 0
+    last, sent = received.pop()
+    assert last == "sent"
+    assert [key for key, _data in received] == list(range(sent))
+
+
+def test_the_head_never_moves_back():
+    """The reader never sees the head half way through being stored"""
+    ring = RingBuffer(2 ** 16)
+    writer = mp.get_context("spawn").Process(
+        target=_writer_main, args=(ring.name, 1.0)
+    )
+    writer.start()
+    heads = []
+    try:
+        while writer.is_alive():
+            ring.get_all()
+            heads.append(ring.head)
+    finally:
+        writer.join(10)
+        ring.close(unlink=True)
+    assert writer.exitcode == 0
+    assert heads == sorted(heads)
@@ -0,0 +1,121 @@
+"""
+The output of both fetchers has to decode to the same events from a
+shared corpus of packets, however the pipe happens to split it
+"""
+import io
+import random
+
+from time import time
+
+import pytest
+
+from mouselounge.capture import split_lines
+from mouselounge.framing import PcapFramer, TcpflowFramer
+from mouselounge.protocol import ProtocolHandler
+from tests.fakes import ID_CHARS, PcapWriter, TcpflowWriter, tribehouse_payload
+
+FETCHERS = {
+    "tcpdump": (PcapWriter, PcapFramer),
+    "tcpflow": (TcpflowWriter, TcpflowFramer),
+}
+SEED = 1
+
+
+def corpus(count, seed):
+    """(flow, payload) of packets with links, broken links and noise"""
+    rng = random.Random(seed)
+    flows = [
+        f"094.023.193.{i:03d}.05555-192.168.001.002.{51000 + i:05d}" for i in range(4)
+    ]
+
+    def noise(size):
+        return bytes(rng.randrange(256) for _ in range(size))
+
+    def link():
+        return tribehouse_payload("".join(rng.choices(ID_CHARS, k=11)))
+
+    packets = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            payload = link()
+        elif kind < 0.5:
+            # cut short, fails to decode on both sides
+            payload = link()[: rng.randrange(4, 40)]
+        elif kind < 0.7:
+            payload = noise(rng.randrange(0, 40)) + b"\n" + link() + b"\n" + noise(8)
+        else:
+            payload = noise(rng.randrange(1, 300))
+        packets.append((rng.choice(flows), payload))
+    return packets
+
+
+PACKETS = corpus(2000, SEED)
+
+
+def stream_of(fetcher, packets=PACKETS):
+    out = io.BytesIO()
+    write = FETCHERS[fetcher][0](out).write
+    for flow, payload in packets:
+        write(payload, time(), flow)
+    return out.getvalue()
+
+
+def decode_stream(fetcher, stream, chunks=()):
+    """Events and records of `stream` read in pieces of `chunks` sizes"""
+    framer = FETCHERS[fetcher][1]()
+    handler = ProtocolHandler()
+    records = []
+    view = memoryview(stream)
+    pos = 0
+    for size in chunks:
+        records += framer.feed(bytes(view[pos : pos + size]))
+        pos += size
+    records += framer.feed(bytes(view[pos:]))
+    records += framer.flush()
+    events = [
+        event for _ts, line in split_lines(records) for event in handler.decode(line)
+    ]
+    return events, records
+
+
+@pytest.fixture(scope="module", params=sorted(FETCHERS))
+def fetcher(request):
+    return request.param
+
+
+def test_records_keep_packets_and_flows(fetcher):
+    _, records = decode_stream(fetcher, stream_of(fetcher))
+    assert [(r.flow, r.payload) for r in records] == PACKETS
+
+
+def test_fetchers_decode_the_same_events():
+    events = {name: decode_stream(name, stream_of(name))[0] for name in FETCHERS}
+    assert events["tcpdump"]
+    assert events["tcpdump"] == events["tcpflow"]
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        [1] * 4096,
+        [random.Random(SEED).randrange(1, 512) for _ in range(4096)],
+        [2 ** 16] * 8,
+    ],
+    ids=["bytes", "random", "pipe"],
+)
+def test_split_reads_decode_the_same(fetcher, chunks):
+    stream = stream_of(fetcher)
+    events, _ = decode_stream(fetcher, stream)
+    assert decode_stream(fetcher, stream, chunks)[0] == events
+
+
+def test_frame_split_across_reads(fetcher):
+    """A link that arrives in two reads still comes out whole"""
+    packets = [(PACKETS[0][0], tribehouse_payload("a" * 11))] * 2
+    stream = stream_of(fetcher, packets)
+    whole, _ = decode_stream(fetcher, stream)
+    assert len(whole) == 2
+    # the cut falls in the middle of the second link
+    middle = len(stream) - len(packets[1][1]) // 2
+    assert decode_stream(fetcher, stream, [middle])[0] == whole
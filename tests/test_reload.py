@@ -0,0 +1,80 @@
+"""
+A reload that fails for one of the managers leaves that one running as it
+was, the new instances only take anything over once all of them are there
+"""
+import asyncio
+import textwrap
+
+from argparse import Namespace
+
+import pytest
+
+from mouselounge.handler import Handler, Managers
+from mouselounge.scheduler import Scheduler
+
+FLAKY = textwrap.dedent(
+    """
+    import os
+
+    import mouselounge.managers as managers
+
+
+    class FlakyManager(managers.XYoutuberCommunityManager):
+        def __init__(self, **kw):
+            super().__init__(**kw)
+            if os.environ.get("FLAKY_BROKEN"):
+                raise RuntimeError("broken on purpose")
+    """
+)
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    (tmp_path / "flaky_managers.py").write_text(FLAKY)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    loop = asyncio.new_event_loop()
+    handler = Handler(Managers(["flaky_managers"]), Namespace(feedmode=False))
+    handler.add_scheduler(Scheduler(loop))
+    yield handler
+    for terminal in {id(m.terminal): m.terminal for m in handler.managers}.values():
+        terminal.close()
+    loop.close()
+
+
+def by_name(handler):
+    return {type(m).__name__: m for m in handler.managers}
+
+
+def test_failed_init_leaves_the_old_instance_alone(handler, monkeypatch):
+    old = by_name(handler)
+    flaky = old["FlakyManager"]
+    monkeypatch.setenv("FLAKY_BROKEN", "1")
+    handler.reload()
+    new = by_name(handler)
+
+    assert new["FlakyManager"] is flaky
+    assert flaky.successor is None
+    assert flaky.streams.helper is flaky
+    assert flaky.media.helper is flaky
+    assert flaky.receiver_callback in flaky.mpvc.cbset
+    # the one that did construct took over from its old instance
+    community = new["XYoutuberCommunityManager"]
+    replaced = old["XYoutuberCommunityManager"]
+    assert community is not replaced
+    assert replaced.successor is community
+    assert community.receiver_callback in community.mpvc.cbset
+    assert replaced.receiver_callback not in community.mpvc.cbset
+
+
+def test_reload_hands_over(handler):
+    old = by_name(handler)["FlakyManager"]
+    handler.reload()
+    new = by_name(handler)["FlakyManager"]
+
+    assert new is not old
+    assert old.successor is new
+    assert new.mpvc is old.mpvc
+    assert new.cooldown is old.cooldown
+    assert new.streams.helper is new
+    assert new.receiver_callback in new.mpvc.cbset
+    assert old.receiver_callback not in new.mpvc.cbset
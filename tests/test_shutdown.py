@@ -0,0 +1,107 @@
+"""
+The shutdown has to stay within its budget, whatever refuses to stop
+"""
+import asyncio
+import os
+import sys
+
+from time import monotonic, sleep
+
+import pytest
+
+from mouselounge.mousapi import Mousapi, _finish
+from mouselounge.processor import Processor
+
+BUDGET = Mousapi.shutdown_budget
+# scheduling and process start up, not something _finish waits for
+SLACK = 0.5
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def finish_in(loop, tasks=(), transports=()):
+    started = monotonic()
+    loop.run_until_complete(_finish(loop, list(tasks), list(transports), BUDGET))
+    return monotonic() - started
+
+
+def test_task_that_ignores_cancel(loop):
+    stop = asyncio.Event()
+
+    async def stubborn():
+        while not stop.is_set():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                pass
+
+    task = loop.create_task(stubborn())
+    loop.run_until_complete(asyncio.sleep(0))
+    task.cancel()
+    elapsed = finish_in(loop, [task])
+    assert not task.done()
+    assert elapsed < BUDGET + SLACK
+
+    stop.set()
+    task.cancel()
+    loop.run_until_complete(task)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs SIGTERM")
+def test_fetcher_that_ignores_sigterm(loop):
+    ignore = (
+        "import signal, time\n"
+        "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+        "print('ready', flush=True)\n"
+        "time.sleep(30)\n"
+    )
+
+    class Ready(asyncio.SubprocessProtocol):
+        def __init__(self):
+            self.ready = loop.create_future()
+
+        def pipe_data_received(self, fd, data):
+            if not self.ready.done():
+                self.ready.set_result(None)
+
+    async def spawn():
+        transport, protocol = await loop.subprocess_exec(
+            Ready, sys.executable, "-c", ignore, stdout=asyncio.subprocess.PIPE
+        )
+        # SIGTERM would still end it before the handler is in place
+        await protocol.ready
+        return transport
+
+    transport = loop.run_until_complete(spawn())
+    try:
+        transport.terminate()
+        elapsed = finish_in(loop, transports=[transport])
+        assert elapsed < BUDGET + SLACK
+        assert elapsed >= BUDGET - SLACK
+    finally:
+        # _finish closes it, which kills what's still running
+        transport.close()
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs a shell")
+def test_processor_stops_the_children_of_its_workers(tmp_path):
+    pidfile = tmp_path / "pid"
+    processor = Processor()
+    try:
+        processor(print, "sh", "-c", f"echo $$ > {pidfile}; exec sleep 30")
+        deadline = monotonic() + 10
+        while not pidfile.exists() or not pidfile.read_text().strip():
+            assert monotonic() < deadline
+            sleep(0.05)
+        pid = int(pidfile.read_text())
+    finally:
+        started = monotonic()
+        processor.close()
+    assert monotonic() - started < BUDGET
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)